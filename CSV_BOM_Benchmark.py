@@ -0,0 +1,195 @@
+# Benchmarks for CSV_BOM_Core against synthetic BOMs.
+# Run outside of Fusion 360, e.g.:
+#   python CSV_BOM_Benchmark.py --rows 1000 10000 100000 --output bench.json
+#   python CSV_BOM_Benchmark.py --rows 1000 10000 --baseline bench.json --threshold 0.25
+# A run compared against a baseline exits non-zero if any case regressed beyond the threshold.
+
+import argparse
+import collections
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import List
+import CSV_BOM_Core as Core
+
+INCH = 2.54
+
+def formatLength(value, fractional, commaDecimal=False):
+    """ Mimic Fusion's formatted output closely enough for writer benchmarks """
+    if not fractional:
+        formatted = "{0:.1f} mm".format(value * 10)
+        return formatted.replace(".", ",") if commaDecimal else formatted
+    inches = value / INCH
+    whole = int(inches)
+    sixteenths = int(round((inches - whole) * 16))
+    if sixteenths == 0:
+        return '{}"'.format(whole)
+    if sixteenths == 16:
+        return '{}"'.format(whole + 1)
+    num, den = sixteenths, 16
+    while num % 2 == 0:
+        num //= 2
+        den //= 2
+    return '{} {}/{}"'.format(whole, num, den)
+
+def generateBom(rows, uniqueParts=None, maxQuantity=4, fractional=False, longNames=False, commaDecimal=False, seed=0) -> List[Core.BomItem]:
+    """ Build a list of rows BomItems. Names repeat every uniqueParts rows (with Fusion style " (n)" and "v2"
+    suffixes so name filtering has work to do). """
+    rnd = random.Random(seed)
+    uniqueParts = uniqueParts or rows
+    materials = ["Birch Plywood", "Oak", "Walnut", "MDF", "Steel", "Aluminum 6061"]
+    suffixes = ["", " (1)", " (2)", " v2", " v3 (4)"]
+    bom = []
+    for i in range(rows):
+        part = i % uniqueParts
+        name = "Part {}".format(part)
+        if longNames:
+            name = "Cabinet carcass assembly / left side panel with dado and rabbet joinery " + name
+        name += suffixes[i % len(suffixes)]
+        x = rnd.uniform(0.5, 3.0)
+        y = rnd.uniform(5, 120)
+        z = rnd.uniform(5, 240)
+        volume = x * y * z
+        density = rnd.uniform(0.0004, 0.008)
+        bom.append(Core.BomItem(name, rnd.randint(1, maxQuantity), "Synthetic part {}".format(part),
+            Core.PhysicalAttributes(
+                Core.Dimensions(x, y, z, formatLength(x, fractional, commaDecimal), formatLength(y, fractional, commaDecimal),
+                    formatLength(z, fractional, commaDecimal)),
+                volume,
+                2 * (x * y + y * z + x * z),
+                volume * density,
+                density,
+                materials[part % len(materials)]
+            )))
+    return bom
+
+def measure(func, rows, memory=True):
+    """ Time func() and optionally record its peak traced allocation in a second run """
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    result = {"rows": rows, "seconds": seconds, "rowsPerSec": rows / seconds if seconds > 0 else None}
+    if memory:
+        tracemalloc.start()
+        func()
+        result["peakBytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+def parseRepeatedly(helper, prefs, templateStr, count):
+    for i in range(count):
+        helper.ParseCsvTemplate(prefs, templateStr)
+
+def filterNamesCold(helper, bom):
+    Core._filterFusionCompNameInserts.cache_clear()
+    return [helper.filterFusionCompNameInserts(item.Name) for item in bom]
+
+def runBenchmarks(rowCounts, fractional=False, longNames=False, commaDecimal=False, maxQuantity=4, memory=True, out=None,
+        uniqueParts=None):
+    """ Returns a dict of case name -> measurement. uniqueParts defaults to half of each row count. """
+    helper = Core.Helper()
+    results = {}
+    # Results are keyed by configuration too, so a baseline is only compared against like runs
+    config = "".join(flag for flag, on in ((" fractional", fractional), (" long names", longNames), (" comma", commaDecimal)) if on)
+    if uniqueParts:
+        config += " {} unique".format(uniqueParts)
+    with open(os.devnull, 'w', newline='') as sink, tempfile.TemporaryDirectory() as fileDir:
+        for rows in rowCounts:
+            bom = generateBom(rows, uniqueParts=min(rows, uniqueParts) if uniqueParts else max(1, rows // 2), maxQuantity=maxQuantity, fractional=fractional,
+                longNames=longNames, commaDecimal=commaDecimal)
+            # Output rows, counting repeats when the quantity field is not used
+            repeated = sum(item.Quantity for item in bom)
+            cases = collections.OrderedDict()
+            for formatName, templateStr in Core.OutputFormats.all.items():
+                prefs = Core.CsvBomPrefs(useCommaDecimal=commaDecimal, lengthUnitString="mm", outputFormat=formatName)
+                writer = Core.OutputFormats.GetWriter(formatName)
+                if formatName in Core.OutputFormats.fileWriters:
+                    # File writers can't write to the null stream; include creating and replacing the file
+                    filename = os.path.join(fileDir, "bench" + Core.OutputFormats.GetExtension(formatName))
+                    cases[formatName] = (lambda p=prefs, f=formatName, n=filename: helper.WriteFormat(n, f, bom, p), rows)
+                    continue
+                if writer:
+                    cases[formatName] = (lambda p=prefs, w=writer: w(helper, sink, bom, p, None), repeated)
+                    continue
+                cases["ParseCsvTemplate " + formatName] = (lambda p=prefs, t=templateStr: parseRepeatedly(helper, p, t, rows), rows)
+                template = helper.ParseCsvTemplate(prefs, templateStr)
+                cases[formatName] = (lambda p=prefs, t=template: helper.WriteCsvFromTemplate(sink, bom, p, t), rows)
+                prefs = Core.CsvBomPrefs(useQuantity=False, useCommaDecimal=commaDecimal, lengthUnitString="mm")
+                template = helper.ParseCsvTemplate(prefs, templateStr)
+                cases[formatName + " no quantity"] = (lambda p=prefs, t=template: helper.WriteCsvFromTemplate(sink, bom, p, t), repeated)
+            # The columnar table that background exports write from, against plain BomItem copies
+            cases["SnapshotBom (BomTable)"] = (lambda: helper.SnapshotBom(bom), rows)
+            cases["BomItem copies"] = (lambda: [Core.BomItem(i.Name, i.Quantity, i.Description, Core.PhysicalAttributes(
+                Core.Dimensions(*[d[0] for d in i.PhysicalAttributes.Dimensions.GetArray()], *i.PhysicalAttributes.Dimensions.GetUnsortedFormatted()),
+                i.PhysicalAttributes.Volume, i.PhysicalAttributes.Area, i.PhysicalAttributes.Mass, i.PhysicalAttributes.Density,
+                i.PhysicalAttributes.Material)) for i in bom], rows)
+            table = helper.SnapshotBom(bom)
+            prefs = Core.CsvBomPrefs(useCommaDecimal=commaDecimal, lengthUnitString="mm")
+            template = helper.ParseCsvTemplate(prefs, Core.OutputFormats.FullCsvTemplate)
+            cases[Core.OutputFormats.FullCsv + " from BomTable"] = (lambda p=prefs, t=template: helper.WriteCsvFromTemplate(sink, table, p, t), rows)
+            cases[Core.OutputFormats.GaryDarby + " from BomTable"] = (lambda p=prefs: helper.WriteCutlistGaryDarby(sink, table, p), repeated)
+            # The writers above have filled the name memo; start each run from an empty one, as an export does
+            cases["filterFusionCompNameInserts"] = (lambda: filterNamesCold(helper, bom), rows)
+            cases["filterFusionCompNameInserts uncached"] = (lambda: [Core._filterFusionCompNameInserts.__wrapped__(item.Name) for item in bom], rows)
+            formatter = Core.LengthFormatter("in", fractionDenominator=16) if fractional else Core.LengthFormatter("mm")
+            cases["LengthFormatter"] = (lambda: [formatter.Format(d) for item in bom
+                for d in item.PhysicalAttributes.Dimensions.GetSortedInternal()], rows)
+
+            for caseName, (func, caseRows) in cases.items():
+                key = "{} [{}{}]".format(caseName, rows, config)
+                results[key] = measure(func, caseRows, memory)
+                if out:
+                    r = results[key]
+                    out.write("{:<70} {:>12.0f} rows/s {:>14}\n".format(key, r["rowsPerSec"] or 0,
+                        "{:.1f} MiB".format(r["peakBytes"] / 1048576) if "peakBytes" in r else ""))
+    return results
+
+def compareResults(results, baseline, threshold=0.25):
+    """ List regressions: cases whose throughput dropped, or peak memory grew, by more than threshold (a fraction) """
+    regressions = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if not previous:
+            continue
+        if previous.get("rowsPerSec") and current.get("rowsPerSec") is not None \
+                and current["rowsPerSec"] < previous["rowsPerSec"] * (1 - threshold):
+            regressions.append("{}: {:.0f} rows/s, baseline {:.0f}".format(key, current["rowsPerSec"], previous["rowsPerSec"]))
+        if previous.get("peakBytes") and "peakBytes" in current \
+                and current["peakBytes"] > previous["peakBytes"] * (1 + threshold):
+            regressions.append("{}: peak {} bytes, baseline {}".format(key, current["peakBytes"], previous["peakBytes"]))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark CSV_BOM_Core writers on synthetic BOMs")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--fractional", action="store_true", help="Format dimensions as fractional inches")
+    parser.add_argument("--long-names", action="store_true")
+    parser.add_argument("--comma", action="store_true", help="Use comma decimal delimiters")
+    parser.add_argument("--max-quantity", type=int, default=4, help="Quantities are drawn from 1..max")
+    parser.add_argument("--unique-parts", type=int, help="Distinct parts per BOM (default: half the rows)")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the traced peak memory run")
+    parser.add_argument("--output", help="Save results as JSON")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed regression as a fraction of the baseline")
+    args = parser.parse_args(argv)
+
+    results = runBenchmarks(args.rows, args.fractional, args.long_names, args.comma, args.max_quantity,
+        not args.no_memory, sys.stdout, args.unique_parts)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compareResults(results, json.load(f), args.threshold)
+        for r in regressions:
+            print("REGRESSION " + r)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,31 @@
+# Consolidates BOMs exported from many designs into one purchasing list, outside of Fusion 360, e.g.:
+#   python CSV_BOM_Consolidate.py exports/*.csv --output purchasing.csv
+# Inputs may be in any of the CSV layouts of CSV_BOM_Core.OutputFormats, with or without the quantity field
+#  (and gzip compressed); see CSV_BOM_Core.BomConsolidator.
+
+import argparse
+import sys
+try:
+    from . import CSV_BOM_Core as Core
+except ImportError:
+    import CSV_BOM_Core as Core
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Merge exported CSV BOMs, summing the quantities of identical parts")
+    parser.add_argument("inputs", nargs="+", help="Exported CSV files")
+    parser.add_argument("--output", required=True, help="Consolidated CSV file")
+    parser.add_argument("--max-entries", type=int, default=100000,
+        help="Unique parts held in memory before spilling sorted runs to disk")
+    args = parser.parse_args(argv)
+
+    try:
+        rows = Core.Helper().ConsolidateFiles(args.inputs, args.output, args.max_entries)
+    except (OSError, ValueError) as e:
+        print("FAILED: {}".format(e))
+        return 1
+    print("{} rows from {} files merged into {}".format(rows, len(args.inputs), args.output))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,56 @@
 # This file does all the hard work of translating a list of objects into a variety of CSV formats.
 # This file is separate to enable unit testing the logic of CSV generation from the Fusion 360 Addin runtime. 
 
+from array import array
 import csv
 import io
 import re
 import collections
+import functools
 import json
-from typing import List
+import math
+import os
+import time
+from typing import Iterable, List
+
+_copyInsertPattern = re.compile(r"\([0-9]+\)$")
+_versionInsertPattern = re.compile(r"v[0-9]+$")
+_whitespacePattern = re.compile(r"\s+")
+
+@functools.lru_cache(maxsize=65536)
+def _filterFusionCompNameInserts(name):
+    name = _copyInsertPattern.sub('', name)
+    name = name.strip()
+    name = _versionInsertPattern.sub('', name)
+    return name.strip()
+
+@functools.lru_cache(maxsize=65536)
+def _normalizeName(name):
+    """ Grouping key for a component name: Fusion inserts removed, case and whitespace folded """
+    return _whitespacePattern.sub(' ', _filterFusionCompNameInserts(name).lstrip('_')).casefold()
+
+@functools.lru_cache(maxsize=65536)
+def _formatLength(rounded, units, precision, fractionDenominator, decimalPoint):
+    """ rounded is in display units, or a count of 1/fractionDenominator display units when using fractions """
+    sign = "-" if rounded < 0 else ""
+    if fractionDenominator:
+        whole, numerator = divmod(abs(rounded), fractionDenominator)
+        if not numerator:
+            return "0" if not whole else sign + str(whole)
+        divisor = math.gcd(numerator, fractionDenominator)
+        fraction = "{}/{}".format(numerator // divisor, fractionDenominator // divisor)
+        return sign + (str(whole) + " " if whole else "") + fraction
+    value = "{0:.{1}f}".format(abs(rounded), precision)
+    if precision:
+        value = value.rstrip('0').rstrip('.')
+    if value == "0":
+        return value
+    return sign + value.replace('.', decimalPoint)
 
 class OutputFormats:
     GaryDarby = "Cutlist (Gary Darby)"
+    SheetYield = "Sheet yield estimate"
+    Sqlite = "SQLite database (All properties, indexed)"
     FullCsv="Full CSV (All properties)"
     FullCsvTemplate = """Part name,Quantity,Volume cm^3,Width {},Length {},Height {},Area cm^2,Mass kg,Density kg/cm^2,Material,Description
 Name,Quantity,Volume,Width,Length,Height,Area,Mass,Density,Material,Description"""
@@ -25,6 +66,64 @@ Name,Length,Width,Quantity,Thickness,SameAsSheet,Material,,,,,,,,,,,,,,,,,,,,,,,
         #"Cutlist (CutList Plus fx)": "" ,
         GaryDarby: ""
     }
+    # Formats that are not written from a template name a writer as "module:attribute". The module is only
+    #  imported when the format is first exported; the writer is called as writer(helper, stream, bom, prefs, useFractions).
+    writers = {
+        GaryDarby: "CSV_BOM_Core:Helper.WriteCutlistGaryDarby"
+    }
+    extensions = {
+        GaryDarby: ".txt"
+    }
+    # Writers that write a (never compressed) file themselves, called with its filename in place of the stream
+    fileWriters = set()
+    _resolvedWriters = {}
+
+    @classmethod
+    def register(cls, name, template="", writer=None, extension=".csv", writesFile=False):
+        """ Add an output format: either a two-line CSV template, or a writer given as "module:attribute" """
+        cls.all[name] = template
+        if writer:
+            cls.writers[name] = writer
+        cls.extensions[name] = extension
+        if writesFile:
+            cls.fileWriters.add(name)
+
+    @classmethod
+    def GetWriter(cls, name):
+        """ The writer callable for name, importing its module on first use, or None for template formats """
+        writer = cls._resolvedWriters.get(name)
+        if writer is None and name in cls.writers:
+            import importlib
+            moduleName, attribute = cls.writers[name].split(":")
+            if __package__:
+                module = importlib.import_module("." + moduleName, __package__)
+            else:
+                module = importlib.import_module(moduleName)
+            writer = module
+            for part in attribute.split("."):
+                writer = getattr(writer, part)
+            cls._resolvedWriters[name] = writer
+        return writer
+
+    @classmethod
+    def GetExtension(cls, name):
+        return cls.extensions.get(name, ".csv")
+
+OutputFormats.register(OutputFormats.Sqlite, writer="CSV_BOM_Sqlite:WriteSqlite", extension=".sqlite", writesFile=True)
+OutputFormats.register(OutputFormats.SheetYield, writer="CSV_BOM_Packing:WriteSheetYield")
+    
+
+class BoundingBoxAccuracy:
+    """ How body bounding boxes are measured """
+    Auto = "Automatic"
+    Fast = "Fast (API box)"
+    Tight = "Tight (display mesh)"
+    Tolerance = "Tolerance (calculated mesh)"
+
+    all = [Auto, Fast, Tight, Tolerance]
+
+    # Auto trusts the API box when the body fills it to within this fraction of the box volume
+    fillThreshold = 0.001
     
 
 class CsvBomPrefs:
@@ -33,7 +132,10 @@ class CsvBomPrefs:
         ignoreUnderscorePrefixedComponents=True, stripUnderscorePrefix=False,
         ignoreCompWoBodies=True, ignoreLinkedComponents=True,
         ignoreVisibleState=True, useCommaDecimal=False, useQuantity=True, lengthUnitString="", 
-        outputFormat=OutputFormats.FullCsv, **kwargs):
+        outputFormat=OutputFormats.FullCsv, deltaExport=False, groupIdenticalParts=False, groupTolerance=0.01,
+        boundingBoxAccuracy=BoundingBoxAccuracy.Auto, meshTolerance=0.01, profileExport=False, profileWithCProfile=False,
+        compressOutput=False, sheetLength=243.84, sheetWidth=121.92, sawKerf=0.3175, materialRollup=False,
+        skipUnchanged=False, **kwargs):
         self.onlySelectedComponents = onlySelectedComponents
         self.sortDimensions=sortDimensions
         self.ignoreUnderscorePrefixedComponents=ignoreUnderscorePrefixedComponents
@@ -45,18 +147,86 @@ class CsvBomPrefs:
         self.useQuantity=useQuantity
         self.lengthUnitString=lengthUnitString
         self.outputFormat=outputFormat
+        self.deltaExport=deltaExport
+        self.groupIdenticalParts=groupIdenticalParts
+        self.groupTolerance=groupTolerance
+        self.boundingBoxAccuracy=boundingBoxAccuracy
+        self.meshTolerance=meshTolerance
+        self.profileExport=profileExport
+        self.profileWithCProfile=profileWithCProfile
+        self.compressOutput=compressOutput
+        # Stock sheet size and saw kerf for the sheet yield estimate, in cm (default 4' x 8' and 1/8")
+        self.sheetLength=sheetLength
+        self.sheetWidth=sheetWidth
+        self.sawKerf=sawKerf
+        self.materialRollup=materialRollup
+        self.skipUnchanged=skipUnchanged
 
     @classmethod
     def from_json(cls, json_str):
         json_dict = json.loads(json_str)
         return cls(**json_dict)
 
+    def GetOutputFormats(self) -> List[str]:
+        """ outputFormat holds either a single format name or a list of them """
+        if isinstance(self.outputFormat, str):
+            return [self.outputFormat]
+        return list(self.outputFormat)
+
     def to_json(self):
         return json.dumps(self.__dict__)
     
 
+class LengthFormatter:
+    """ Formats internal lengths (cm) like fusionUnitsManager.formatInternalValue(value, units, False), without the API call """
+    __slots__ = ("Units", "Precision", "FractionDenominator", "DecimalPoint", "_scale")
+
+    # Internal units (cm) per display unit, for each of Fusion's default length units
+    UnitScales = {"mm": 0.1, "cm": 1.0, "m": 100.0, "in": 2.54, "ft": 30.48}
+
+    def __init__(self, units, precision=3, fractionDenominator=0, decimalPoint="."):
+        self.Units = units
+        self.Precision = precision
+        self.FractionDenominator = fractionDenominator
+        self.DecimalPoint = decimalPoint
+        self._scale = LengthFormatter.UnitScales[units]
+
+    @staticmethod
+    def FromUnitsManager(unitsManager, units):
+        """ Read the display settings from one formatted value. Returns None for units this formatter doesn't know. """
+        if units not in LengthFormatter.UnitScales:
+            return None
+        # A third of a unit never terminates, so it shows every decimal (or the finest fraction) in use
+        probe = unitsManager.formatInternalValue(LengthFormatter.UnitScales[units] / 3, units, False)
+        if '/' in probe:
+            return LengthFormatter(units, fractionDenominator=int(probe.rsplit('/', 1)[1]))
+        for decimalPoint in ('.', ','):
+            if decimalPoint in probe:
+                return LengthFormatter(units, len(probe.rsplit(decimalPoint, 1)[1]), decimalPoint=decimalPoint)
+        return LengthFormatter(units, 0)
+
+    def Format(self, internalValue: float) -> str:
+        value = internalValue / self._scale
+        if self.FractionDenominator:
+            rounded = int(round(value * self.FractionDenominator))
+        else:
+            rounded = round(value, self.Precision)
+        return _formatLength(rounded, self.Units, self.Precision, self.FractionDenominator, self.DecimalPoint)
+
+    def Check(self, unitsManager, internalValues) -> list:
+        """ Compare against the API; returns (internalValue, api, formatted) for every value formatted differently """
+        mismatches = []
+        for internalValue in internalValues:
+            expected = unitsManager.formatInternalValue(internalValue, self.Units, False)
+            formatted = self.Format(internalValue)
+            if formatted != expected:
+                mismatches.append((internalValue, expected, formatted))
+        return mismatches
+
+
 class Dimensions:
     """ Internal values should be floats and sortable (cm), while Formatted are strings (incl. fractional inches) """
+    __slots__ = ("_X", "_Y", "_Z")
 
     def __init__(self, xInternal: float, yInternal: float, zInternal: float, xFormatted: str, yFormatted: str, zFormatted: str):
         self._X = [xInternal, xFormatted]
@@ -71,16 +241,18 @@ class Dimensions:
         return sorted(self.GetArray(), key=lambda d: d[0], reverse=True)
 
     def GetSortedInternal(self):
-        return list(map(lambda t: t[0], self.GetSortedTuples()))
+        return [t[0] for t in self.GetSortedTuples()]
 
     def GetSortedFormatted(self):
-        return list(map(lambda t: t[1], self.GetSortedTuples()))
+        return [t[1] for t in self.GetSortedTuples()]
 
     def GetUnsortedFormatted(self):
-        return list(map(lambda t: t[1], self.GetArray()))
+        return [self._X[1], self._Y[1], self._Z[1]]
 
 
 class PhysicalAttributes:
+    __slots__ = ("Volume", "Dimensions", "Area", "Mass", "Density", "Material")
+
     def __init__(self, dimensions: Dimensions, volume, area, mass, density, material):
         self.Volume = volume
         self.Dimensions = dimensions
@@ -90,6 +262,8 @@ class PhysicalAttributes:
         self.Material = material
 
 class BomItem:
+    __slots__ = ("Name", "Quantity", "Description", "Component", "PhysicalAttributes")
+
     def __init__(self, name, quantity, description, physicalAttributes: PhysicalAttributes, component=None):
         self.Name = name
         self.Quantity = quantity
@@ -97,15 +271,877 @@ class BomItem:
         self.Component = component
         self.PhysicalAttributes = physicalAttributes
 
-class Helper:
+class BomTable:
+    """ Columnar storage for large BOMs. Numeric values live in flat arrays (dimensions are N x 3) and the
+    dimension sort order is computed in bulk. Iterating yields BomTableRow views, which the writers accept
+    in place of BomItems. """
+
     def __init__(self):
-        pass
+        self.Names = []
+        self.Quantities = array('l')
+        self.Descriptions = []
+        self.Components = []
+        self.DimensionsInternal = array('d')
+        self.DimensionsFormatted = []
+        self.Volumes = array('d')
+        # Rows whose volume is an int (e.g. 0 for components without solid bodies); it is written with str()
+        self.IntegerVolumes = set()
+        self.Areas = array('d')
+        self.Masses = array('d')
+        self.Densities = array('d')
+        self.Materials = []
+        # BomDelta change per row, None outside of delta exports
+        self.Changes = []
+        # Per row, the indices (0-2) of the dimensions sorted largest first
+        self.SortOrder = array('b')
+
+    def __len__(self):
+        return len(self.Names)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.Names)
+        if not 0 <= i < len(self.Names):
+            raise IndexError(i)
+        return BomTableRow(self, i)
+
+    def __iter__(self):
+        self._SortPending()
+        for i in range(len(self.Names)):
+            yield BomTableRow(self, i)
+
+    def appendValues(self, name, quantity, description, x, y, z, xFormatted, yFormatted, zFormatted,
+                     volume, area, mass, density, material, component=None, change=None):
+        self.Names.append(name)
+        self.Quantities.append(quantity)
+        self.Descriptions.append(description)
+        self.Components.append(component)
+        self.DimensionsInternal.extend((x, y, z))
+        self.DimensionsFormatted.extend((xFormatted, yFormatted, zFormatted))
+        if type(volume) is int:
+            self.IntegerVolumes.add(len(self.Volumes))
+        self.Volumes.append(volume)
+        self.Areas.append(area)
+        self.Masses.append(mass)
+        self.Densities.append(density)
+        self.Materials.append(material)
+        self.Changes.append(change)
+
+    def append(self, item: BomItem, keepComponent=True):
+        p = item.PhysicalAttributes
+        (x, xF), (y, yF), (z, zF) = p.Dimensions.GetArray()
+        self.appendValues(item.Name, item.Quantity, item.Description, x, y, z, xF, yF, zF,
+            p.Volume, p.Area, p.Mass, p.Density, p.Material, item.Component if keepComponent else None,
+            getattr(item, "Change", None))
+
+    def detached(self):
+        """ A table sharing this table's columns, without its components """
+        table = BomTable.__new__(BomTable)
+        table.__dict__.update(self.__dict__)
+        table.Components = [None] * len(self.Names)
+        return table
+
+    @classmethod
+    def from_items(cls, items: Iterable[BomItem], keepComponents=True):
+        table = cls()
+        for item in items:
+            table.append(item, keepComponents)
+        table._SortPending()
+        return table
+
+    def _SortPending(self):
+        """ Compute the sort order for every row appended since the last call """
+        dims = self.DimensionsInternal
+        order = self.SortOrder
+        for start in range(len(order), len(dims), 3):
+            x, y, z = dims[start], dims[start + 1], dims[start + 2]
+            # Stable descending sort of three values, matching Dimensions.GetSortedTuples
+            if x >= y:
+                if y >= z:
+                    order.extend((0, 1, 2))
+                elif x >= z:
+                    order.extend((0, 2, 1))
+                else:
+                    order.extend((2, 0, 1))
+            else:
+                if x >= z:
+                    order.extend((1, 0, 2))
+                elif y >= z:
+                    order.extend((1, 2, 0))
+                else:
+                    order.extend((2, 1, 0))
+
+class BomTableRow:
+    """ A BomItem-compatible view of one BomTable row. It serves as its own PhysicalAttributes and Dimensions. """
+    __slots__ = ("_table", "_i")
+
+    def __init__(self, table: BomTable, i: int):
+        self._table = table
+        self._i = i
+
+    @property
+    def Name(self):
+        return self._table.Names[self._i]
+
+    @property
+    def Quantity(self):
+        return self._table.Quantities[self._i]
+
+    @Quantity.setter
+    def Quantity(self, value):
+        self._table.Quantities[self._i] = value
+
+    @property
+    def Description(self):
+        return self._table.Descriptions[self._i]
+
+    @property
+    def Component(self):
+        return self._table.Components[self._i]
+
+    @property
+    def Change(self):
+        return self._table.Changes[self._i]
+
+    @property
+    def PhysicalAttributes(self):
+        return self
+
+    @property
+    def Dimensions(self):
+        return self
+
+    @property
+    def Volume(self):
+        t = self._table
+        if self._i in t.IntegerVolumes:
+            return int(t.Volumes[self._i])
+        return t.Volumes[self._i]
+
+    @property
+    def Area(self):
+        return self._table.Areas[self._i]
+
+    @property
+    def Mass(self):
+        return self._table.Masses[self._i]
+
+    @property
+    def Density(self):
+        return self._table.Densities[self._i]
+
+    @property
+    def Material(self):
+        return self._table.Materials[self._i]
+
+    def _Order(self):
+        t = self._table
+        start = self._i * 3
+        if len(t.SortOrder) <= start:
+            t._SortPending()
+        order = t.SortOrder
+        return start, order[start], order[start + 1], order[start + 2]
+
+    def GetArray(self):
+        t = self._table
+        start = self._i * 3
+        return [[t.DimensionsInternal[start + j], t.DimensionsFormatted[start + j]] for j in range(3)]
+
+    def GetSortedTuples(self):
+        a = self.GetArray()
+        _, i, j, k = self._Order()
+        return [a[i], a[j], a[k]]
+
+    def GetSortedInternal(self):
+        start, i, j, k = self._Order()
+        dims = self._table.DimensionsInternal
+        return [dims[start + i], dims[start + j], dims[start + k]]
+
+    def GetSortedFormatted(self):
+        start, i, j, k = self._Order()
+        dims = self._table.DimensionsFormatted
+        return [dims[start + i], dims[start + j], dims[start + k]]
+
+    def GetUnsortedFormatted(self):
+        start = self._i * 3
+        return self._table.DimensionsFormatted[start:start + 3]
+
+class BomAccumulator:
+    """ Collects unique BomItems in the order they are first seen, keyed by a hashable component key
+    (e.g. the Fusion entityToken) so repeat occurrences are counted in constant time. """
+
+    def __init__(self):
+        self._items = [] # type: List[BomItem]
+        self._index = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def get(self, key) -> BomItem:
+        return self._index.get(key)
+
+    def increment(self, key, count=1) -> bool:
+        """ Add count to the quantity of an existing row. Returns False if the key has not been seen. """
+        item = self._index.get(key)
+        if item is None:
+            return False
+        item.Quantity += count
+        return True
+
+    def add(self, key, item: BomItem) -> BomItem:
+        """ Append a new row for key; if key is already present its quantity is incremented instead. """
+        existing = self._index.get(key)
+        if existing is not None:
+            existing.Quantity += item.Quantity
+            return existing
+        self._index[key] = item
+        self._items.append(item)
+        return item
+
+    def items(self) -> List[BomItem]:
+        return self._items
+
+class ComponentCache:
+    """ LRU cache of per-component geometry and physical properties, keyed by component identity and
+    invalidated by a change fingerprint. Values are plain dicts so the cache round-trips through JSON
+    (e.g. a design attribute) between exports. """
+
+    def __init__(self, maxEntries=5000):
+        self.maxEntries = maxEntries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, fingerprint):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != fingerprint:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, fingerprint, value: dict):
+        self._entries[key] = [fingerprint, value]
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxEntries:
+            self._entries.popitem(last=False)
+
+    def reserve(self, count):
+        """ Make room for count components. Every export visits the components in the same order, so a cache
+        smaller than the design would evict each entry just before it is used again. """
+        self.maxEntries = max(self.maxEntries, count)
+
+    @classmethod
+    def from_json(cls, json_str, maxEntries=5000):
+        entries = json.loads(json_str)
+        # Keep everything a previous export reserved room for
+        cache = cls(max(maxEntries, len(entries)))
+        for key, entry in entries:
+            cache.put(key, entry[0], entry[1])
+        return cache
+
+    def to_json(self):
+        # Stored as a list to preserve LRU order
+        return json.dumps(list(self._entries.items()))
+
+class BomChange(BomItem):
+    """ A BomItem in a delta export, with Change set to one of BomDelta.Added, Removed or Changed """
+    __slots__ = ("Change",)
+
+    def __init__(self, change, item: BomItem):
+        super().__init__(item.Name, item.Quantity, item.Description, item.PhysicalAttributes, item.Component)
+        self.Change = change
+
+class BomDelta:
+    """ Compares a BOM against a compact snapshot of the previously exported BOM. Both sides are keyed by
+    component (e.g. entity token), so the comparison is a single hash join over the current rows. """
+    Added = "Added"
+    Removed = "Removed"
+    Changed = "Changed"
+
+    def __init__(self, previous: dict=None):
+        self.previous = dict(previous or {})
+        self.current = {}
+
+    @staticmethod
+    def SnapshotRow(item: BomItem):
+        p = item.PhysicalAttributes
+        (x, xF), (y, yF), (z, zF) = p.Dimensions.GetArray()
+        return [item.Name, item.Quantity, x, y, z, xF, yF, zF, p.Material, p.Mass]
+
+    @staticmethod
+    def ItemFromSnapshotRow(row) -> BomItem:
+        name, quantity, x, y, z, xF, yF, zF, material, mass = row
+        return BomItem(name, quantity, "", PhysicalAttributes(Dimensions(x, y, z, xF, yF, zF), 0, 0, mass, 0, material))
+
+    def record(self, keyedItems):
+        """ Pass (key, BomItem) pairs through as BomItems, recording the snapshot for the next export """
+        for key, item in keyedItems:
+            self.current[key] = self.SnapshotRow(item)
+            yield item
+
+    def changes(self, keyedItems):
+        """ Yield a BomChange for every added or changed item, then for every item no longer present """
+        previous = dict(self.previous)
+        for key, item in keyedItems:
+            row = self.SnapshotRow(item)
+            self.current[key] = row
+            before = previous.pop(key, None)
+            if before is None:
+                yield BomChange(BomDelta.Added, item)
+            elif before != row:
+                yield BomChange(BomDelta.Changed, item)
+        for row in previous.values():
+            yield BomChange(BomDelta.Removed, self.ItemFromSnapshotRow(row))
+
+    @classmethod
+    def from_json(cls, json_str):
+        return cls(json.loads(json_str))
+
+    def to_json(self):
+        """ The snapshot of the current BOM """
+        return json.dumps(self.current)
+
+class ContentHash:
+    """ Streaming hash of everything an export depends on: the target filename and prefs, then every row as it
+    is generated. Equal digests mean the export would write the same files again. """
+
+    def __init__(self, prefs: CsvBomPrefs, filename=""):
+        import hashlib
+        self._hash = hashlib.blake2b(digest_size=20)
+        self._hash.update(repr((os.path.abspath(filename), prefs.to_json())).encode())
+
+    def update(self, item: BomItem):
+        p = item.PhysicalAttributes
+        row = (item.Name, item.Quantity, item.Description, tuple(map(tuple, p.Dimensions.GetArray())),
+            p.Volume, p.Area, p.Mass, p.Density, p.Material, getattr(item, "Change", None))
+        self._hash.update(repr(row).encode())
+
+    def observe(self, bom: Iterable[BomItem]):
+        """ Pass bom through unchanged, hashing each item on the way """
+        for item in bom:
+            self.update(item)
+            yield item
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+class MaterialRollup:
+    """ Totals per material and thickness (the smallest dimension), accumulated while the BOM streams to a writer.
+    Each group is one fixed-size array of [parts, area, volume, mass], counting every instance. """
+    Parts, Area, Volume, Mass = range(4)
+
+    def __init__(self, thicknessTolerance=1e-4):
+        self.thicknessTolerance = thicknessTolerance
+        self._totals = {}
+        # (material, formatted thickness) of each group, in first-seen order
+        self._labels = collections.OrderedDict()
+
+    def add(self, item: BomItem):
+        # Removed parts are no longer in the design
+        if getattr(item, "Change", None) == BomDelta.Removed:
+            return
+        p = item.PhysicalAttributes
+        thickness = p.Dimensions.GetSortedTuples()[2]
+        key = (p.Material, round(thickness[0] / self.thicknessTolerance))
+        totals = self._totals.get(key)
+        if totals is None:
+            totals = self._totals[key] = array('d', bytes(32))
+            self._labels[key] = (p.Material, thickness[1])
+        quantity = item.Quantity
+        totals[MaterialRollup.Parts] += quantity
+        totals[MaterialRollup.Area] += p.Area * quantity
+        totals[MaterialRollup.Volume] += p.Volume * quantity
+        totals[MaterialRollup.Mass] += p.Mass * quantity
+
+    def observe(self, bom: Iterable[BomItem]):
+        """ Pass bom through unchanged, adding each item on the way """
+        for item in bom:
+            self.add(item)
+            yield item
+
+    def rows(self):
+        """ (material, formatted thickness, totals) per group """
+        for key, (material, thickness) in self._labels.items():
+            yield material, thickness, self._totals[key]
+
+    def Write(self, stream, prefs: CsvBomPrefs):
+        """ One CSV row per material and thickness, then a total row """
+        decimal = (lambda v: v.replace('.', ',')) if prefs.useCommaDecimal else (lambda v: v)
+        writer = csv.writer(stream)
+        writer.writerow(["Material", "Thickness {}".format(prefs.lengthUnitString), "Parts", "Area cm^2", "Volume cm^3", "Mass kg"])
+        grandTotal = array('d', bytes(32))
+        for material, thickness, totals in self.rows():
+            writer.writerow([material, thickness, int(totals[MaterialRollup.Parts]), decimal("{0:.2f}".format(totals[MaterialRollup.Area])),
+                decimal("{0:.2f}".format(totals[MaterialRollup.Volume])), decimal("{0:.5f}".format(totals[MaterialRollup.Mass]))])
+            for i in range(4):
+                grandTotal[i] += totals[i]
+        writer.writerow(["Total", "", int(grandTotal[MaterialRollup.Parts]), decimal("{0:.2f}".format(grandTotal[MaterialRollup.Area])),
+            decimal("{0:.2f}".format(grandTotal[MaterialRollup.Volume])), decimal("{0:.5f}".format(grandTotal[MaterialRollup.Mass]))])
+
+
+class BomConsolidator:
+    """ Merges previously exported CSVs, in any template layout of OutputFormats, into one list. Parts with the same
+    normalized name, dimensions (as formatted, with their unit) and material are one row with the summed quantity.
+    Files are streamed and at most maxEntries parts are held in memory; beyond that sorted runs are spilled to
+    temporary files and merged at the end. Rows come out sorted by normalized name, dimensions and material. """
+    Columns = ["Part name", "Quantity", "Width", "Length", "Height", "Unit", "Material"]
+    DimensionFields = ("Width", "Length", "Height")
+
+    def __init__(self, maxEntries=100000, tempDir=None, helper=None):
+        self.maxEntries = maxEntries
+        self.tempDir = tempDir
+        self.helper = helper or Helper()
+        # (normalized name, width, length, height, unit, material) -> [name, quantity]
+        self._parts = {}
+        self._runs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        """ Remove any spilled runs """
+        for run in self._runs:
+            if os.path.exists(run):
+                os.remove(run)
+        self._runs = []
+
+    def Layout(self, header):
+        """ Match a header row against the template formats. Returns (format name, length unit, field -> column index,
+        whether the file is a delta export); exports written without the quantity field match too. """
+        change = bool(header) and header[0] == "Change"
+        if change:
+            header = header[1:]
+        for formatName, template in OutputFormats.all.items():
+            if not template:
+                continue
+            # Keep the unit placeholder in the parsed header names
+            parsed = self.helper.ParseCsvTemplate(CsvBomPrefs(lengthUnitString="{}"), template)
+            for withQuantity in (True, False):
+                names = [k for k, v in parsed.items() if withQuantity or v != "Quantity"]
+                unit = self._MatchHeader(names, header)
+                if unit is None:
+                    continue
+                columns = {}
+                for i, name in enumerate(names):
+                    # Only the first column mapped to a field holds its value
+                    columns.setdefault(parsed[name], i + change)
+                return formatName, unit, columns, change
+        raise ValueError("Not an exported CSV BOM layout: {}".format(",".join(header)))
+
+    @staticmethod
+    def _MatchHeader(names, header):
+        """ The length unit if header matches the template names, "" if they have no unit, or None if they don't match """
+        if len(names) != len(header):
+            return None
+        unit = ""
+        for pattern, cell in zip(names, header):
+            if "{}" not in pattern:
+                if pattern != cell:
+                    return None
+                continue
+            prefix, suffix = pattern.split("{}", 1)
+            if len(cell) < len(prefix) + len(suffix) or not cell.startswith(prefix) or not cell.endswith(suffix):
+                return None
+            unit = cell[len(prefix):len(cell) - len(suffix)]
+        return unit
+
+    def AddFile(self, path) -> int:
+        """ Stream one exported CSV (optionally gzip compressed) into the totals. Returns the rows read. """
+        if path.endswith(".gz"):
+            import gzip
+            f = gzip.open(path, 'rt', newline='')
+        else:
+            f = open(path, newline='')
+        rows = 0
+        with f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header is None:
+                return 0
+            formatName, unit, columns, change = self.Layout(header)
+            nameColumn = columns["Name"]
+            quantityColumn = columns.get("Quantity")
+            dimensionColumns = [columns.get(field) for field in BomConsolidator.DimensionFields]
+            materialColumn = columns.get("Material")
+            for row in reader:
+                if not row or (change and row[0] == BomDelta.Removed):
+                    continue
+                rows += 1
+                # Without a quantity field, every instance has its own row
+                quantity = int(row[quantityColumn]) if quantityColumn is not None else 1
+                dims = tuple(row[c] if c is not None else "" for c in dimensionColumns)
+                material = row[materialColumn] if materialColumn is not None else ""
+                self.Add(row[nameColumn], quantity, dims, unit, material)
+        return rows
+
+    def Add(self, name, quantity, dims, unit="", material=""):
+        key = (self.helper.normalizeName(name),) + tuple(dims) + (unit, material)
+        part = self._parts.get(key)
+        if part is None:
+            self._parts[key] = [name, quantity]
+            if len(self._parts) >= self.maxEntries:
+                self._Spill()
+        else:
+            part[1] += quantity
+
+    def _Spill(self):
+        import tempfile
+        handle, run = tempfile.mkstemp(suffix=".bomrun", dir=self.tempDir)
+        self._runs.append(run)
+        with open(handle, 'w', newline='') as f:
+            writer = csv.writer(f)
+            for key in sorted(self._parts):
+                name, quantity = self._parts[key]
+                writer.writerow(key + (name, quantity))
+        self._parts = {}
+
+    @staticmethod
+    def _ReadRun(run):
+        with open(run, newline='') as f:
+            for row in csv.reader(f):
+                yield tuple(row[:6]), row[6], int(row[7])
+
+    def Rows(self):
+        """ Yield the merged [name, quantity, width, length, height, unit, material] rows """
+        if not self._runs:
+            for key in sorted(self._parts):
+                name, quantity = self._parts[key]
+                yield [name, quantity] + list(key[1:])
+            return
+
+        import heapq
+        if self._parts:
+            self._Spill()
+        current = None
+        for key, name, quantity in heapq.merge(*(self._ReadRun(run) for run in self._runs), key=lambda r: r[0]):
+            if current is not None and current[0] == key:
+                current[2] += quantity
+                continue
+            if current is not None:
+                yield [current[1], current[2]] + list(current[0][1:])
+            current = [key, name, quantity]
+        if current is not None:
+            yield [current[1], current[2]] + list(current[0][1:])
+
+    def Write(self, stream):
+        writer = csv.writer(stream)
+        writer.writerow(BomConsolidator.Columns)
+        writer.writerows(self.Rows())
+
+
+class ExportCancelledError(Exception):
+    """ Raised from an ExportProgress callback to abort the export """
+    pass
+
+class ExportProgress:
+    """ Per-phase counters for a running export. Every chunkSize steps the callback is called with this object;
+    it may update a progress display and raise ExportCancelledError to abort. """
+    Occurrences = "occurrences"
+    Components = "components"
+    # Rows prepared for writing
+    Rows = "rows"
+
+    def __init__(self, callback=None, chunkSize=50):
+        self.callback = callback
+        self.chunkSize = chunkSize
+        self.counts = collections.OrderedDict([(ExportProgress.Occurrences, 0), (ExportProgress.Components, 0), (ExportProgress.Rows, 0)])
+        # The expected number of unique components, once known
+        self.total = 0
+        self._pending = 0
+
+    def step(self, phase, count=1):
+        self.counts[phase] += count
+        self._pending += count
+        if self._pending >= self.chunkSize:
+            self.report()
+
+    def report(self):
+        self._pending = 0
+        if self.callback:
+            self.callback(self)
+
+    def track(self, items: Iterable, phase):
+        """ Pass items through, stepping phase for each """
+        for item in items:
+            yield item
+            self.step(phase)
+
+class _ProfilerPhase:
+    __slots__ = ("profiler", "name")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._Enter(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._Exit()
+        return False
+
+class _NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class Profiler:
+    """ Registry of per-phase wall time, call counts and API call counts. Phases nest; time spent in an inner
+    phase (e.g. bounding boxes computed while the writer pulls rows) is not counted again in the outer one.
+    Each thread nests its own phases, so writers on worker threads can share a Profiler.
+    A disabled Profiler costs next to nothing, so the hooks can stay in place. """
+    _nullPhase = _NullPhase()
+
+    def __init__(self, enabled=True):
+        import threading
+        self.enabled = enabled
+        self.phases = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def phase(self, name):
+        """ Context manager timing one call of a phase """
+        if not self.enabled:
+            return Profiler._nullPhase
+        return _ProfilerPhase(self, name)
+
+    def count(self, apiCalls=1):
+        """ Record Fusion API calls against the current phase """
+        if self.enabled:
+            stack = self._Stack()
+            if stack:
+                with self._lock:
+                    self.phases[stack[-1]]["apiCalls"] += apiCalls
+
+    def _Stack(self):
+        local = self._local
+        if not hasattr(local, "stack"):
+            local.stack = []
+            local.resumed = 0.0
+        return local.stack
+
+    def _Stats(self, name):
+        stats = self.phases.get(name)
+        if stats is None:
+            stats = self.phases[name] = {"seconds": 0.0, "calls": 0, "apiCalls": 0}
+        return stats
+
+    def _Enter(self, name):
+        now = time.perf_counter()
+        stack = self._Stack()
+        with self._lock:
+            if stack:
+                self.phases[stack[-1]]["seconds"] += now - self._local.resumed
+            self._Stats(name)["calls"] += 1
+        stack.append(name)
+        self._local.resumed = now
+
+    def _Exit(self):
+        now = time.perf_counter()
+        stack = self._Stack()
+        with self._lock:
+            self.phases[stack.pop()]["seconds"] += now - self._local.resumed
+        self._local.resumed = now
+
+    def to_json(self):
+        with self._lock:
+            return json.dumps(self.phases, indent=2)
+
+    def WriteSidecar(self, filename) -> str:
+        """ Write the results next to an exported file, e.g. "bom.csv.profile.json" """
+        sidecar = filename + ".profile.json"
+        with open(sidecar, 'w') as f:
+            f.write(self.to_json())
+        return sidecar
+
+class AtomicOutput:
+    """ Context manager for the text stream every writer writes to. Output goes through a large buffer into a
+    temporary file next to filename (optionally gzip compressed), which replaces filename only once writing
+    succeeds, so a failed or cancelled export never leaves a truncated file behind. With openStream=False the
+    temporary filename is returned instead, for writers that create the file themselves. """
+    bufferSize = 1 << 20
+
+    def __init__(self, filename, compress=False, openStream=True):
+        self.filename = filename
+        self.compress = compress
+        self.openStream = openStream
+        self.tempFilename = "{}.{}.tmp".format(filename, os.urandom(4).hex())
+        self.stream = None
+
+    def __enter__(self):
+        if not self.openStream:
+            return self.tempFilename
+        if self.compress:
+            import gzip
+            compressed = gzip.GzipFile(self.tempFilename, 'wb')
+            self.stream = io.TextIOWrapper(io.BufferedWriter(compressed, AtomicOutput.bufferSize), newline='')
+        else:
+            self.stream = open(self.tempFilename, 'w', newline='', buffering=AtomicOutput.bufferSize)
+        return self.stream
+
+    def __exit__(self, excType, excValue, tb):
+        try:
+            if self.stream:
+                # Flushes the last buffer, which can fail (e.g. a full disk) after every write succeeded
+                self.stream.close()
+            if excType is None:
+                os.replace(self.tempFilename, self.filename)
+                return False
+        except BaseException:
+            self._RemoveTemporary()
+            raise
+        self._RemoveTemporary()
+        return False
+
+    def _RemoveTemporary(self):
+        try:
+            os.remove(self.tempFilename)
+        except OSError:
+            pass
+
+class BackgroundExport:
+    """ Runs Helper.SaveFile on a worker thread against a detached snapshot of the BOM (see Helper.SnapshotBom), so the
+    caller returns as soon as the snapshot is taken. Nothing here touches the Fusion API. When writing finishes,
+    onComplete(export) is called on the worker thread with filenames set, or error and traceback if writing failed.
+    state carries whatever the caller should only save once the files are written, e.g. the caches behind the BOM. """
+
+    def __init__(self, helper, filename, bom: Iterable[BomItem], prefs: CsvBomPrefs, useFractions=None, onComplete=None):
+        self.helper = helper
+        self.filename = filename
+        # Taken on the calling thread: this is where the BOM generator (and any Fusion API access) runs
+        contentHash = ContentHash(prefs, filename)
+        self.bom = helper.SnapshotBom(contentHash.observe(bom))
+        self.digest = contentHash.hexdigest()
+        # With prefs.skipUnchanged, the files from the last export are still up to date
+        self.unchanged = prefs.skipUnchanged and helper.IsUnchanged(filename, prefs, self.digest)
+        self.prefs = CsvBomPrefs.from_json(prefs.to_json())
+        self.useFractions = useFractions
+        self.onComplete = onComplete
+        self.filenames = None
+        self.error = None
+        self.traceback = None
+        self.state = None
+        import threading
+        self._thread = threading.Thread(target=self._Run, name="CSV-BOM export", daemon=True)
+
+    def start(self):
+        """ Start writing, unless the export is unchanged """
+        if not self.unchanged:
+            self._thread.start()
+        return self
+
+    def join(self, timeout=None):
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def _Run(self):
+        try:
+            self.filenames = self.helper.SaveFile(self.filename, self.bom, self.prefs, self.useFractions)
+            # A record left by an earlier export would no longer describe the files
+            if self.prefs.skipUnchanged:
+                self.helper.WriteContentHash(self.filename, self.digest, self.filenames)
+            else:
+                self.helper.RemoveContentHash(self.filename)
+        except Exception as e:
+            import traceback
+            self.error = e
+            self.traceback = traceback.format_exc()
+            # Some of the files may have been replaced before the failure
+            try:
+                self.helper.RemoveContentHash(self.filename)
+            except OSError:
+                pass
+        if self.onComplete:
+            self.onComplete(self)
+
+class Helper:
+    # Phase names recorded by Helper and BomWalker
+    ParsePhase = "template parsing"
+    WritePhase = "file writing"
+
+    def __init__(self, profiler: Profiler=None):
+        self.profiler = profiler if profiler is not None else Profiler(enabled=False)
 
     def filterFusionCompNameInserts(self, name):
-        name = re.sub(r"\([0-9]+\)$", '', name)
-        name = name.strip()
-        name = re.sub(r"v[0-9]+$", '', name)
-        return name.strip()
+        return _filterFusionCompNameInserts(name)
+
+    def normalizeName(self, name):
+        """ Grouping key for a component name: Fusion inserts and a leading underscore removed, case and whitespace folded """
+        return _normalizeName(name)
+
+    def SnapshotBom(self, bom: Iterable[BomItem]) -> BomTable:
+        """ Copy the BOM without its Fusion components into a compact BomTable, so it can be written on
+        another thread. The dimension sort order is computed here, not from several writer threads at once.
+        When bom is every row of one BomTable in order (as BomWalker.generateBomItems yields them), the snapshot
+        shares that table's columns instead of copying them. """
+        items = iter(bom)
+        source = None
+        count = 0
+        for item in items:
+            if type(item) is BomTableRow and item._i == count and (source is None or item._table is source):
+                source = item._table
+                count += 1
+                continue
+            # Anything else is copied, including the rows seen so far
+            table = BomTable.from_items((source[i] for i in range(count)), keepComponents=False)
+            table.append(item, keepComponent=False)
+            for item in items:
+                table.append(item, keepComponent=False)
+            table._SortPending()
+            return table
+        if source is None:
+            return BomTable()
+        if count < len(source):
+            return BomTable.from_items((source[i] for i in range(count)), keepComponents=False)
+        source._SortPending()
+        return source.detached()
+
+    def GroupBom(self, bom: Iterable[BomItem], prefs: CsvBomPrefs) -> List[BomItem]:
+        """ Merge items that are the same part under different names ("Shelf (1)", "Shelf v2"): same normalized
+        name, same sorted dimensions within prefs.groupTolerance (cm), and same material. Quantities are summed
+        into the first item of each group; the input items are not modified. """
+        tolerance = prefs.groupTolerance or 1e-9
+        groups = {}
+        grouped = []
+        for item in bom:
+            p = item.PhysicalAttributes
+            key = (self.normalizeName(item.Name),
+                tuple(round(d / tolerance) for d in p.Dimensions.GetSortedInternal()),
+                p.Material,
+                getattr(item, "Change", None))
+            head = groups.get(key)
+            if head is None:
+                change = key[3]
+                if change is not None:
+                    head = BomChange(change, item)
+                else:
+                    head = BomItem(item.Name, item.Quantity, item.Description, p, item.Component)
+                groups[key] = head
+                grouped.append(head)
+            else:
+                head.Quantity += item.Quantity
+        return grouped
 
     def replacePointDelimterOnPref(self, useComma: bool, value: str):
         """ Replace decimal point in str(number) with a comma """
@@ -113,17 +1149,142 @@ class Helper:
             return str(value).replace(".", ",")
         return str(value)
 
-    def SaveFile(self, filename, bom: List[BomItem], prefs: CsvBomPrefs):
-        """ Determine the correct output option from prefs.outputFormat"""
-        with open(filename, 'w', newline='') as csvFile:
-            if prefs.outputFormat == OutputFormats.GaryDarby:
-                self.WriteCutlistGaryDarby(csvFile, bom, prefs)
+    def FormatFilename(self, filename, outputFormat):
+        """ Derive a per-format filename, e.g. "cabinet.csv" -> "cabinet - Cutlist_Maxcut.csv" """
+        stem, extension = os.path.splitext(filename)
+        if OutputFormats.GetExtension(outputFormat) != ".csv":
+            extension = OutputFormats.GetExtension(outputFormat)
+        formatSlug = re.sub(r"[^A-Za-z0-9]+", "_", outputFormat).strip("_")
+        return "{} - {}{}".format(stem, formatSlug, extension or ".csv")
+
+    def SaveFile(self, filename, bom: Iterable[BomItem], prefs: CsvBomPrefs, useFractions=None) -> List[str]:
+        """ Write every format in prefs.outputFormat and return the filenames written. bom may be any iterable
+        (e.g. a generator); for a single format rows are streamed to the file as they are produced. With several
+        formats the BOM is built once, each format is written to its own file (see FormatFilename) concurrently. """
+        formats = prefs.GetOutputFormats()
+        if prefs.groupIdenticalParts:
+            bom = self.GroupBom(bom, prefs)
+        rollup = None
+        if prefs.materialRollup:
+            # Totalled as the writer consumes the rows
+            rollup = MaterialRollup()
+            bom = rollup.observe(bom)
+        filenames = self.OutputFilenames(filename, prefs)
+        if len(formats) == 1:
+            self.WriteFormat(filenames[0], formats[0], bom, prefs, useFractions)
+            return filenames[:1] + self.WriteRollup(filename, rollup, prefs)
+
+        # Imported here to keep loading this module cheap
+        import concurrent.futures
+
+        # Every writer is fed from the same rows
+        if not isinstance(bom, BomTable):
+            bom = list(bom)
+        filenames = filenames[:len(formats)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(formats)) as pool:
+            futures = [pool.submit(self.WriteFormat, f, outputFormat, bom, prefs, useFractions)
+                for f, outputFormat in zip(filenames, formats)]
+            for future in futures:
+                # Re-raise any writer error
+                future.result()
+        return filenames + self.WriteRollup(filename, rollup, prefs)
+
+    def OutputFilenames(self, filename, prefs: CsvBomPrefs) -> List[str]:
+        """ The files SaveFile writes for filename, without writing them """
+        formats = prefs.GetOutputFormats()
+        if len(formats) == 1:
+            filenames = [self.CompressedFilename(filename, prefs, formats[0])]
+        else:
+            filenames = [self.CompressedFilename(self.FormatFilename(filename, outputFormat), prefs, outputFormat) for outputFormat in formats]
+        if prefs.materialRollup:
+            filenames.append(self.RollupFilename(filename))
+        return filenames
+
+    def ConsolidateFiles(self, paths, filename, maxEntries=100000) -> int:
+        """ Merge exported CSVs into one purchasing list at filename (see BomConsolidator). Returns the rows read. """
+        rows = 0
+        with BomConsolidator(maxEntries, os.path.dirname(os.path.abspath(filename)), self) as consolidator:
+            for path in paths:
+                rows += consolidator.AddFile(path)
+            with self.profiler.phase(Helper.WritePhase), AtomicOutput(filename) as stream:
+                consolidator.Write(stream)
+        return rows
+
+    def HashFilename(self, filename):
+        """ Where the content hash of the last export to filename is kept, e.g. "bom.csv.bomhash" """
+        return filename + ".bomhash"
+
+    def FileStamp(self, filename):
+        """ Size and modification time, to notice files changed since they were exported """
+        stat = os.stat(filename)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def WriteContentHash(self, filename, digest, filenames):
+        """ Record the digest of the export just written to filenames, with their stamps """
+        content = json.dumps({"digest": digest, "files": {f: self.FileStamp(f) for f in filenames}})
+        with AtomicOutput(self.HashFilename(filename)) as f:
+            f.write(content)
+
+    def RemoveContentHash(self, filename):
+        """ Forget the last export to filename, e.g. once it is written without recording its digest """
+        try:
+            os.remove(self.HashFilename(filename))
+        except FileNotFoundError:
+            pass
+
+    def IsUnchanged(self, filename, prefs: CsvBomPrefs, digest) -> bool:
+        """ True if the last export to filename had the same content hash and its files are all still there,
+        unmodified since """
+        try:
+            with open(self.HashFilename(filename)) as f:
+                recorded = json.load(f)
+            if recorded["digest"] != digest:
+                return False
+            stamps = recorded["files"]
+            return all(stamps.get(f) == self.FileStamp(f) for f in self.OutputFilenames(filename, prefs))
+        except (OSError, ValueError, KeyError, TypeError):
+            # Missing files, or a missing or unreadable record
+            return False
+
+    def RollupFilename(self, filename):
+        """ e.g. "cabinet.csv" -> "cabinet - Material_rollup.csv" """
+        stem = filename[:-3] if filename.endswith(".gz") else filename
+        return "{} - Material_rollup.csv".format(os.path.splitext(stem)[0])
+
+    def WriteRollup(self, filename, rollup: MaterialRollup, prefs: CsvBomPrefs) -> List[str]:
+        """ Write the rollup gathered while writing filename, if any. Returns the filenames written. """
+        if rollup is None:
+            return []
+        rollupFilename = self.RollupFilename(filename)
+        with self.profiler.phase(Helper.WritePhase), AtomicOutput(rollupFilename) as stream:
+            rollup.Write(stream, prefs)
+        return [rollupFilename]
+
+    def CompressedFilename(self, filename, prefs: CsvBomPrefs, outputFormat=None):
+        if prefs.compressOutput and outputFormat not in OutputFormats.fileWriters and not filename.endswith(".gz"):
+            return filename + ".gz"
+        return filename
+
+    def WriteFormat(self, filename, outputFormat, bom: Iterable[BomItem], prefs: CsvBomPrefs, useFractions=None):
+        """ Write a single output format to filename. If writing fails or is cancelled, the file is left untouched. """
+        writer = OutputFormats.GetWriter(outputFormat)
+        if outputFormat in OutputFormats.fileWriters:
+            with self.profiler.phase(Helper.WritePhase), AtomicOutput(filename, openStream=False) as tempFilename:
+                writer(self, tempFilename, bom, prefs, useFractions)
+            return
+        with self.profiler.phase(Helper.WritePhase), AtomicOutput(filename, prefs.compressOutput) as csvFile:
+            if writer:
+                writer(self, csvFile, bom, prefs, useFractions)
             else:
-                template = self.ParseCsvTemplate(prefs, OutputFormats.all[prefs.outputFormat])
+                template = self.ParseCsvTemplate(prefs, OutputFormats.all[outputFormat])
                 self.WriteCsvFromTemplate(csvFile, bom, prefs, template)
 
     def ParseCsvTemplate(self, prefs: CsvBomPrefs, template) -> collections.OrderedDict:
         """Take a two-line CSV template and parse it into a dict for writing to arbitrary CSVs"""
+        with self.profiler.phase(Helper.ParsePhase):
+            return self._ParseCsvTemplate(prefs, template)
+
+    def _ParseCsvTemplate(self, prefs: CsvBomPrefs, template) -> collections.OrderedDict:
         f = io.StringIO(template)
 
         d = collections.OrderedDict()
@@ -139,87 +1300,114 @@ class Helper:
                 break
         return d
 
+    # Valid template fields
+    fieldNames = ["Name","Quantity","Volume","Width","Length","Height","Area","Mass","Density","Material","Description"]
+    # Compiled templates, keyed on the parsed template and the prefs that change the emitted columns
+    _compiledTemplates = {}
 
+    def CompileCsvTemplate(self, prefs: CsvBomPrefs, template: collections.OrderedDict):
+        """ Compile a parsed template into a header row and a tuple of column extractors.
+        Each extractor is called as extractor(item, name, dimensions) and returns the cell value. """
+        key = (tuple(template.items()), prefs.useQuantity, prefs.useCommaDecimal, prefs.deltaExport)
+        compiled = Helper._compiledTemplates.get(key)
+        if compiled is not None:
+            return compiled
 
-        
+        if prefs.useCommaDecimal:
+            commaTable = str.maketrans(".", ",")
+            decimal = lambda fmt: lambda v: fmt(v).translate(commaTable)
+        else:
+            decimal = lambda fmt: fmt
+        volumeFmt = decimal(str)
+        areaFmt = decimal("{0:.2f}".format)
+        massFmt = decimal("{0:.5f}".format)
+
+        # Fusion 360 API doesn't make it easy to convert area, mass, or density.
+        # This code works:
+        #  design.fusionUnitsManager.convert(1.0, "in * in * in / lbmass", "cm * cm * cm / kg") 
+        # But the units manager doesn't expose user preferences other than lenght/distance units
+        #  http://help.autodesk.com/view/fusion360/ENU/?guid=GUID-40dda15b-8dec-4122-b0fa-cbd604cd35b5
+        extractors = {
+            "Name": lambda item, name, dims: name,
+            "Quantity": lambda item, name, dims: item.Quantity,
+            "Volume": lambda item, name, dims: volumeFmt(item.PhysicalAttributes.Volume),
+            "Width": lambda item, name, dims: dims[0],
+            "Length": lambda item, name, dims: dims[1],
+            "Height": lambda item, name, dims: dims[2],
+            "Area": lambda item, name, dims: areaFmt(item.PhysicalAttributes.Area),
+            "Mass": lambda item, name, dims: massFmt(item.PhysicalAttributes.Mass),
+            "Density": lambda item, name, dims: massFmt(item.PhysicalAttributes.Density),
+            "Material": lambda item, name, dims: item.PhysicalAttributes.Material,
+            "Description": lambda item, name, dims: item.Description
+        }
+        blank = lambda item, name, dims: ""
+
+        header = []
+        columns = []
+        seen = set()
+        if prefs.deltaExport:
+            # Delta exports lead with the kind of change
+            header.append("Change")
+            columns.append(lambda item, name, dims: getattr(item, "Change", ""))
+        for k, v in template.items():
+            if v == "Quantity" and not prefs.useQuantity:
+                continue
+            header.append(k)
+            # Only the first column mapped to a field receives its value
+            if v in extractors and v not in seen:
+                seen.add(v)
+                columns.append(extractors[v])
+            else:
+                columns.append(blank)
 
+        compiled = (tuple(header), tuple(columns))
+        Helper._compiledTemplates[key] = compiled
+        return compiled
 
-    def WriteCsvFromTemplate(self, f, bom: List[BomItem], prefs: CsvBomPrefs, template: collections.OrderedDict):
-        # Valid fields:
-        fieldNames = ["Name","Quantity","Volume","Width","Length","Height","Area","Mass","Density","Material","Description"] 
-
-        # Construct an inverted template, because we'll want it for mapping values
-        # Find the index of the value, find the corresponding key, add to ordered dict
-        invertedTemplate = collections.OrderedDict()
-        for v in template.values():
-            if v in fieldNames:
-                i = list(template.values()).index(v)
-                invertedTemplate[v] = list(template.keys())[i]
-               
-        if(not prefs.useQuantity and "Quantity" in template.values()):
-            del template[invertedTemplate["Quantity"]]
-
-        csvKeys = list(template.keys())
-        valueKeys = list(invertedTemplate.keys())
-            
-        # Extras Action = Ignore means that when items in the dict are encountered that
-        #  are not present in the header, they are ignored. This lets us perform all the
-        #  conditional logic of which fields to include just once up front when 
-        #  building the header.
-        writer = csv.DictWriter(f, fieldnames=csvKeys, extrasaction='ignore')
-        writer.writeheader()
+    def WriteCsvFromTemplate(self, f, bom: Iterable[BomItem], prefs: CsvBomPrefs, template: collections.OrderedDict):
+        header, columns = self.CompileCsvTemplate(prefs, template)
+        stripUnderscore = prefs.ignoreUnderscorePrefixedComponents is False and prefs.stripUnderscorePrefix is True
+
+        writer = csv.writer(f)
+        writer.writerow(header)
+        # Repeated rows are formatted once here and written in bulk
+        line = io.StringIO(newline='')
+        lineWriter = csv.writer(line)
 
         for item in bom:
+            name = self.filterFusionCompNameInserts(item.Name)
+            if stripUnderscore and name.startswith('_'):
+                name = name[1:]
+            if prefs.sortDimensions:
+                dimensions = item.PhysicalAttributes.Dimensions.GetSortedFormatted()
+            else:
+                dimensions = item.PhysicalAttributes.Dimensions.GetUnsortedFormatted()
+
+            row = [column(item, name, dimensions) for column in columns]
             # If we don't use a quanitity flag, then repeat the row
-            repeat = 1
-            if not prefs.useQuantity:
-                repeat = item.Quantity
-                
-            for r in range(repeat):
-                csvRow = {}
-                name = self.filterFusionCompNameInserts(item.Name)
-                if prefs.ignoreUnderscorePrefixedComponents is False and prefs.stripUnderscorePrefix is True and name[0] == '_':
-                    name = name[1:]
-                
-                if "Name" in valueKeys:
-                    csvRow[invertedTemplate["Name"]] = name
-                if "Quantity" in valueKeys:
-                    csvRow[invertedTemplate["Quantity"]] = item.Quantity
-                if "Volume" in valueKeys:
-                    csvRow[invertedTemplate["Volume"]] = self.replacePointDelimterOnPref(prefs.useCommaDecimal, item.PhysicalAttributes.Volume)
-                
-                #############
-                if prefs.sortDimensions:
-                    dimensions = item.PhysicalAttributes.Dimensions.GetSortedFormatted()
-                else:
-                    dimensions = item.PhysicalAttributes.Dimensions.GetUnsortedFormatted()
-                if "Width" in valueKeys:                
-                    csvRow[invertedTemplate["Width"]] = dimensions[0]
-                if "Length" in valueKeys:
-                    csvRow[invertedTemplate["Length"]] = dimensions[1]
-                if "Height" in valueKeys:
-                    csvRow[invertedTemplate["Height"]] = dimensions[2]
-            
-                # Fusion 360 API doesn't make it easy to convert area, mass, or density.
-                # This code works:
-                #  design.fusionUnitsManager.convert(1.0, "in * in * in / lbmass", "cm * cm * cm / kg") 
-                # But the units manager doesn't expose user preferences other than lenght/distance units
-                #  http://help.autodesk.com/view/fusion360/ENU/?guid=GUID-40dda15b-8dec-4122-b0fa-cbd604cd35b5
-                if "Area" in valueKeys:
-                    csvRow[invertedTemplate["Area"]] = self.replacePointDelimterOnPref(prefs.useCommaDecimal, "{0:.2f}".format(item.PhysicalAttributes.Area))
-                if "Mass" in valueKeys:
-                    csvRow[invertedTemplate["Mass"]] = self.replacePointDelimterOnPref(prefs.useCommaDecimal, "{0:.5f}".format(item.PhysicalAttributes.Mass))
-                if "Density" in valueKeys:
-                    csvRow[invertedTemplate["Density"]] = self.replacePointDelimterOnPref(prefs.useCommaDecimal, "{0:.5f}".format(item.PhysicalAttributes.Density))
-                if "Material" in valueKeys:
-                    csvRow[invertedTemplate["Material"]] = item.PhysicalAttributes.Material
-                if "Description" in valueKeys:
-                    csvRow[invertedTemplate["Description"]] = item.Description
-                
-                writer.writerow(csvRow)
-
-
-    def WriteCutlistGaryDarby(self, stream: io.IOBase, bom: List[BomItem], prefs):
+            if prefs.useQuantity or item.Quantity == 1:
+                writer.writerow(row)
+            else:
+                line.seek(0)
+                line.truncate()
+                lineWriter.writerow(row)
+                f.write(line.getvalue() * item.Quantity)
+
+
+    def DetectFractions(self, item: BomItem, prefs: CsvBomPrefs):
+        """ Look at all dimensions for a decimal or fraction separator to determine integer handling.
+        Returns None if the item's dimensions are all integers and therefore inconclusive. """
+        useFractions = None
+        for dim in item.PhysicalAttributes.Dimensions.GetUnsortedFormatted():
+            if '/' in dim:
+                return True
+            if (not prefs.useCommaDecimal and '.' in dim) or (prefs.useCommaDecimal and ',' in dim):
+                useFractions = False
+        return useFractions
+
+    def WriteCutlistGaryDarby(self, stream: io.IOBase, bom: Iterable[BomItem], prefs, useFractions=None):
+        """ useFractions may be precomputed from the length units; otherwise it is detected from the first
+        conclusive item, holding back only the inconclusive items before it """
         # Init CutList Header
         stream.write('V2\n')
         if prefs.useCommaDecimal:
@@ -229,41 +1417,43 @@ class Helper:
         stream.write('\n')
         stream.write('Required\n')
 
-        useFractions = None
+        pending = []
         for item in bom:
-            # Look at all dimensions for a decimal or fraction separator to determine integer handling
-            for dim in item.PhysicalAttributes.Dimensions.GetUnsortedFormatted():
-                if '/' in dim:
-                    useFractions = True
-                    break
-                if (not prefs.useCommaDecimal and '.' in dim) or (prefs.useCommaDecimal and ',' in dim):
-                    useFractions = False
-            if useFractions is not None:
-                break
-        if useFractions is None:
-            useFractions = False
+            # Removed parts have nothing left to cut
+            if getattr(item, "Change", None) == BomDelta.Removed:
+                continue
+            if useFractions is None:
+                useFractions = self.DetectFractions(item, prefs)
+                if useFractions is None:
+                    pending.append(item)
+                    continue
+                for p in pending:
+                    self._WriteGaryDarbyPart(stream, p, prefs, useFractions)
+                pending = []
+            self._WriteGaryDarbyPart(stream, item, prefs, useFractions)
+        for p in pending:
+            self._WriteGaryDarbyPart(stream, p, prefs, False)
 
-        for item in bom:
-            #add parts:
-            name = self.filterFusionCompNameInserts(item.Name)
-            if prefs.ignoreUnderscorePrefixedComponents is False and prefs.stripUnderscorePrefix is True and name[0] == '_':
-                name = name[1:]
-            
-            if prefs.sortDimensions:
-                dims = item.PhysicalAttributes.Dimensions.GetSortedFormatted()
-            else:
-                dims = item.PhysicalAttributes.Dimensions.GetUnsortedFormatted()
+        # empty entry for available materials (sheets):
+        stream.write('\n' + "Available" + '\n')
 
-            for i in range(len(dims)):
-                # GD Cutlist requires integer legths to end with "0/0" when using fractions
-                if useFractions and '/' not in dims[i]:
-                    dims[i] += " 0/0"
-            
-            partStr = " {0}\t{1}\t{2} (thickness: {3})\n".format(dims[0], dims[1], name, dims[2])
+    def _WriteGaryDarbyPart(self, stream: io.IOBase, item: BomItem, prefs, useFractions):
+        #add parts:
+        name = self.filterFusionCompNameInserts(item.Name)
+        if prefs.ignoreUnderscorePrefixedComponents is False and prefs.stripUnderscorePrefix is True and name.startswith('_'):
+            name = name[1:]
+        
+        if prefs.sortDimensions:
+            dims = item.PhysicalAttributes.Dimensions.GetSortedFormatted()
+        else:
+            dims = item.PhysicalAttributes.Dimensions.GetUnsortedFormatted()
 
-            # add all instances of the component to the CutList:
-            for i in range(0, item.Quantity):
-                stream.write(partStr)
+        for i in range(len(dims)):
+            # GD Cutlist requires integer legths to end with "0/0" when using fractions
+            if useFractions and '/' not in dims[i]:
+                dims[i] += " 0/0"
+        
+        partStr = " {0}\t{1}\t{2} (thickness: {3})\n".format(dims[0], dims[1], name, dims[2])
 
-        # empty entry for available materials (sheets):
-        stream.write('\n' + "Available" + '\n')
\ No newline at end of file
+        # add all instances of the component to the CutList:
+        stream.write(partStr * item.Quantity)
@@ -0,0 +1,70 @@
+# Bounding box math over flat mesh coordinate buffers.
+# This file is separate from the Fusion 360 Addin runtime so it can be unit tested and benchmarked
+#  against synthetic coordinate buffers.
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def boundsFromCoordinates(coordinates):
+    """ Reduce a flat [x0, y0, z0, x1, y1, z1, ...] buffer (e.g. MeshTriangle.nodeCoordinatesAsDouble)
+    to a (minX, minY, minZ, maxX, maxY, maxZ) tuple. Returns None for an empty buffer. """
+    if len(coordinates) < 3:
+        return None
+    if numpy is not None:
+        points = numpy.asarray(coordinates, dtype=numpy.float64).reshape(-1, 3)
+        low = points.min(axis=0)
+        high = points.max(axis=0)
+        return (float(low[0]), float(low[1]), float(low[2]), float(high[0]), float(high[1]), float(high[2]))
+
+    if not isinstance(coordinates, array):
+        coordinates = array('d', coordinates)
+    xs = coordinates[0::3]
+    ys = coordinates[1::3]
+    zs = coordinates[2::3]
+    return (min(xs), min(ys), min(zs), max(xs), max(ys), max(zs))
+
+
+def unionBounds(boundsList):
+    """ Combine (minX, minY, minZ, maxX, maxY, maxZ) tuples, seeding from the first one. Returns None if empty. """
+    result = None
+    for b in boundsList:
+        if result is None:
+            result = list(b)
+            continue
+        for i in range(3):
+            if b[i] < result[i]:
+                result[i] = b[i]
+            if b[i + 3] > result[i + 3]:
+                result[i + 3] = b[i + 3]
+    if result is None:
+        return None
+    return tuple(result)
+
+
+def boundsSize(bounds):
+    """ Convert a bounds tuple to the {"x", "y", "z"} extents dict used when building Dimensions """
+    if bounds is None:
+        return {"x": 0, "y": 0, "z": 0}
+    return {
+        "x": bounds[3] - bounds[0],
+        "y": bounds[4] - bounds[1],
+        "z": bounds[5] - bounds[2]
+    }
+
+
+def boxVolume(bounds):
+    return (bounds[3] - bounds[0]) * (bounds[4] - bounds[1]) * (bounds[5] - bounds[2])
+
+
+def isFilledBox(bounds, volume, threshold):
+    """ True if a body of the given volume fills its axis-aligned bounds to within threshold (a fraction of the box
+    volume), i.e. the body is a plain box and the bounds are already tight """
+    box = boxVolume(bounds)
+    if box <= 0:
+        return False
+    return abs(box - volume) <= box * threshold
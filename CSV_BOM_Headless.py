@@ -0,0 +1,246 @@
+# Headless batch exporter. Reads serialized design snapshots (JSON) through small stand-ins for the adsk objects
+#  that CSV_BOM_Walker touches, and exports them in parallel outside of Fusion 360, e.g.:
+#   python CSV_BOM_Headless.py archive/*.json --output-dir cutlists --format "Cutlist (Maxcut)" --processes 8
+#
+# Snapshot layout (lengths in cm, like Fusion's internal units):
+# {
+#   "name": "Cabinet",
+#   "defaultLengthUnits": "mm",
+#   "rootComponent": "root",
+#   "components": {
+#     "root": {"name": "Cabinet", "occurrences": [{"component": "side", "isVisible": true}]},
+#     "side": {"name": "Side", "description": "", "revisionId": "1", "linked": false,
+#              "occurrences": [],
+#              "bodies": [{"isSolid": true, "volume": 100.0, "area": 240.0, "mass": 0.07, "density": 0.0007,
+#                          "material": "Oak", "boundingBox": [0, 0, 0, 1.8, 40, 70]}]}
+#   }
+# }
+# Optional "lengthPrecision" (decimals, default 3) and "fractionDenominator" (e.g. 16 for fractional inches) set how
+#  lengths are displayed, like Fusion's unit preferences.
+# A body may give "mesh" (flat x, y, z node coordinates) instead of, or as well as, the API "boundingBox".
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+try:
+    from . import CSV_BOM_Core as Core
+    from . import CSV_BOM_Geometry as Geometry
+    from . import CSV_BOM_Walker as Walker
+except ImportError:
+    import CSV_BOM_Core as Core
+    import CSV_BOM_Geometry as Geometry
+    import CSV_BOM_Walker as Walker
+
+
+class StandInCollection:
+    def __init__(self, items):
+        self._items = list(items)
+
+    @property
+    def count(self):
+        return len(self._items)
+
+    def item(self, i):
+        return self._items[i]
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+class StandInMaterial:
+    def __init__(self, name):
+        self.name = name
+
+class StandInPhysicalProperties:
+    def __init__(self, area, mass, density):
+        self.area = area
+        self.mass = mass
+        self.density = density
+
+class StandInPoint:
+    def __init__(self, x, y, z):
+        self.x = x
+        self.y = y
+        self.z = z
+
+class StandInBoundingBox:
+    def __init__(self, bounds):
+        self.minPoint = StandInPoint(*bounds[0:3])
+        self.maxPoint = StandInPoint(*bounds[3:6])
+
+class StandInMesh:
+    def __init__(self, nodeCoordinatesAsDouble):
+        self.nodeCoordinatesAsDouble = nodeCoordinatesAsDouble
+
+class StandInMeshManager:
+    """ Serves the snapshot mesh both as the display mesh and from the mesh calculator """
+    def __init__(self, mesh: StandInMesh):
+        self.mesh = mesh
+        self.bestMesh = mesh
+        self.surfaceTolerance = 0
+
+    @property
+    def displayMeshes(self):
+        return self
+
+    def createMeshCalculator(self):
+        return self
+
+    def calculate(self):
+        return self.mesh
+
+class StandInBody:
+    def __init__(self, snapshot: dict):
+        self.isSolid = snapshot.get("isSolid", True)
+        self.volume = snapshot.get("volume", 0.0)
+        self.physicalProperties = StandInPhysicalProperties(snapshot.get("area", 0.0), snapshot.get("mass", 0.0), snapshot.get("density", 0.0))
+        self.material = StandInMaterial(snapshot["material"]) if snapshot.get("material") else None
+        if "mesh" in snapshot:
+            coordinates = snapshot["mesh"]
+        else:
+            # The corners of the box are enough of a mesh for its tight bounding box
+            coordinates = list(snapshot.get("boundingBox", [0, 0, 0, 0, 0, 0]))
+        self.meshManager = StandInMeshManager(StandInMesh(coordinates))
+        # The API box may be looser than the mesh; without one, the mesh bounds stand in for it
+        self.boundingBox = StandInBoundingBox(snapshot.get("boundingBox") or Geometry.boundsFromCoordinates(coordinates))
+
+class StandInOccurrence:
+    def __init__(self, component, isVisible=True, fullPathName=None):
+        self.component = component
+        self.isVisible = isVisible
+        self.fullPathName = fullPathName or component.name
+
+class StandInComponent:
+    def __init__(self, entityToken, snapshot: dict, design):
+        self.entityToken = entityToken
+        self.name = snapshot.get("name", entityToken)
+        self.description = snapshot.get("description", "")
+        self.revisionId = snapshot.get("revisionId", "")
+        # Linked components belong to another design
+        self.parentDesign = object() if snapshot.get("linked") else design
+        self.bRepBodies = StandInCollection(StandInBody(b) for b in snapshot.get("bodies", []))
+        self.occurrences = StandInCollection([])
+
+    @property
+    def allOccurrences(self):
+        """ Every occurrence below this component, once per path, like Fusion's occurrence proxies """
+        result = []
+        def walk(component, parentVisible, parentPath):
+            for i, occ in enumerate(component.occurrences):
+                visible = parentVisible and occ.isVisible
+                path = parentPath + "{}:{}".format(occ.component.name, i + 1)
+                result.append(StandInOccurrence(occ.component, visible, path))
+                walk(occ.component, visible, path + "+")
+        walk(self, True, "")
+        return StandInCollection(result)
+
+class StandInUnitsManager:
+    def __init__(self, defaultLengthUnits, precision=3, fractionDenominator=0):
+        self.defaultLengthUnits = defaultLengthUnits
+        self.precision = precision
+        self.fractionDenominator = fractionDenominator
+
+    def formatInternalValue(self, internalValue, units, showUnits=True):
+        value = Core.LengthFormatter(units, self.precision, self.fractionDenominator).Format(internalValue)
+        if showUnits:
+            value += " " + units
+        return value
+
+class StandInAttribute:
+    def __init__(self, value):
+        self.value = value
+
+class StandInAttributes:
+    def __init__(self):
+        self._attributes = {}
+
+    def itemByName(self, groupName, name):
+        return self._attributes.get((groupName, name))
+
+    def add(self, groupName, name, value):
+        attribute = StandInAttribute(value)
+        self._attributes[(groupName, name)] = attribute
+        return attribute
+
+class StandInDesign:
+    def __init__(self, snapshot: dict):
+        self.name = snapshot.get("name", "")
+        self.fusionUnitsManager = StandInUnitsManager(snapshot.get("defaultLengthUnits", "cm"),
+            snapshot.get("lengthPrecision", 3), snapshot.get("fractionDenominator", 0))
+        self.attributes = StandInAttributes()
+        components = {token: StandInComponent(token, c, self) for token, c in snapshot["components"].items()}
+        for token, c in snapshot["components"].items():
+            components[token].occurrences = StandInCollection(
+                StandInOccurrence(components[o["component"]], o.get("isVisible", True)) for o in c.get("occurrences", []))
+        self.rootComponent = components[snapshot["rootComponent"]]
+
+
+def exportDesign(design: StandInDesign, outputDir, formats, prefs: Core.CsvBomPrefs, baseName=None):
+    """ Walk the design once and write every format in formats, named "<baseName> - <format>". Returns the written filenames. """
+    preferredUnits = design.fusionUnitsManager.defaultLengthUnits
+    prefs = Core.CsvBomPrefs.from_json(prefs.to_json())
+    prefs.lengthUnitString = preferredUnits
+
+    walker = Walker.BomWalker(design, prefs, preferredUnits)
+    bom = walker.countComponents(design.rootComponent.occurrences)
+
+    helper = Core.Helper()
+    filename = os.path.join(outputDir, (baseName or design.name) + ".csv")
+    if len(formats) == 1:
+        # SaveFile only suffixes the format when writing several
+        filename = helper.FormatFilename(filename, formats[0])
+    prefs.outputFormat = list(formats)
+    return helper.SaveFile(filename, walker.generateBomItems(bom), prefs)
+
+def exportSnapshotFile(path, outputDir, formats, prefsJson):
+    """ Process pool entry point; returns the written filenames """
+    with open(path) as f:
+        design = StandInDesign(json.load(f))
+    baseName = os.path.splitext(os.path.basename(path))[0]
+    return exportDesign(design, outputDir, formats, Core.CsvBomPrefs.from_json(prefsJson), baseName)
+
+def exportMany(paths, outputDir, formats, prefs: Core.CsvBomPrefs, processes=None):
+    """ Export every snapshot across a process pool. Returns {path: filenames or the exception raised}. """
+    os.makedirs(outputDir, exist_ok=True)
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {pool.submit(exportSnapshotFile, path, outputDir, formats, prefs.to_json()): path for path in paths}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                results[futures[future]] = e
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export BOMs from design snapshots outside of Fusion 360")
+    parser.add_argument("snapshots", nargs="+", help="Design snapshot JSON files")
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument("--format", action="append", dest="formats", choices=list(Core.OutputFormats.all.keys()),
+        help="Output format; repeat for several. Defaults to all formats.")
+    parser.add_argument("--prefs", help="CsvBomPrefs JSON file, e.g. the add-in's last used options")
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    prefs = Core.CsvBomPrefs()
+    if args.prefs:
+        with open(args.prefs) as f:
+            prefs = Core.CsvBomPrefs.from_json(f.read())
+    formats = args.formats or list(Core.OutputFormats.all.keys())
+
+    failed = 0
+    for path, result in exportMany(args.snapshots, args.output_dir, formats, prefs, args.processes).items():
+        if isinstance(result, Exception):
+            failed += 1
+            print("FAILED {}: {}".format(path, result))
+        else:
+            for filename in result:
+                print(filename)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
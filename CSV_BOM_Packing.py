@@ -0,0 +1,167 @@
+# Estimates how many stock sheets a BOM needs, per material and thickness, with a shelf (guillotine) packing heuristic.
+# Registered in CSV_BOM_Core.OutputFormats as a writer, so this module is only imported when the format is exported.
+# Parts are kept as parallel arrays of unique sizes and counts rather than one object per part.
+
+from array import array
+import csv
+
+try:
+    from . import CSV_BOM_Core as Core
+except ImportError:
+    import CSV_BOM_Core as Core
+
+
+class FirstFitTree:
+    """ Remaining capacity per bin in a max segment tree, finding the first bin with room in O(log n) """
+    def __init__(self):
+        self._size = 1
+        self._tree = array('d', [0.0, 0.0])
+        self.count = 0
+
+    def append(self, capacity) -> int:
+        if self.count == self._size:
+            leaves = self._tree[self._size:self._size + self.count]
+            self._size *= 2
+            self._tree = array('d', bytes(16 * self._size))
+            self._tree[self._size:self._size + self.count] = leaves
+            for pos in range(self._size - 1, 0, -1):
+                self._tree[pos] = max(self._tree[2 * pos], self._tree[2 * pos + 1])
+        self.count += 1
+        self.update(self.count - 1, capacity)
+        return self.count - 1
+
+    def update(self, index, capacity):
+        tree = self._tree
+        pos = index + self._size
+        tree[pos] = capacity
+        pos //= 2
+        while pos:
+            tree[pos] = max(tree[2 * pos], tree[2 * pos + 1])
+            pos //= 2
+
+    def find(self, needed) -> int:
+        """ Index of the first bin with at least needed capacity, or -1 """
+        tree = self._tree
+        if tree[1] < needed:
+            return -1
+        pos = 1
+        while pos < self._size:
+            pos *= 2
+            if tree[pos] < needed:
+                pos += 1
+        return pos - self._size
+
+    def __getitem__(self, index):
+        return self._tree[index + self._size]
+
+
+class SheetGroup:
+    """ The parts of one material and thickness; each unique part size is stored once with its count """
+    __slots__ = ("Material", "Thickness", "ThicknessFormatted", "Lengths", "Widths", "Counts", "_index")
+
+    def __init__(self, material, thickness, thicknessFormatted):
+        self.Material = material
+        self.Thickness = thickness
+        self.ThicknessFormatted = thicknessFormatted
+        self.Lengths = array('d')
+        self.Widths = array('d')
+        self.Counts = array('l')
+        self._index = {}
+
+    def add(self, length, width, count):
+        key = (length, width)
+        i = self._index.get(key)
+        if i is None:
+            self._index[key] = len(self.Counts)
+            self.Lengths.append(length)
+            self.Widths.append(width)
+            self.Counts.append(count)
+        else:
+            self.Counts[i] += count
+
+    def partCount(self):
+        return sum(self.Counts)
+
+    def partArea(self):
+        return sum(l * w * c for l, w, c in zip(self.Lengths, self.Widths, self.Counts))
+
+
+class PackingResult:
+    __slots__ = ("Sheets", "Oversized", "PartArea", "Yield")
+
+    def __init__(self, sheets, oversized, partArea, sheetArea):
+        self.Sheets = sheets
+        self.Oversized = oversized
+        self.PartArea = partArea
+        self.Yield = partArea / (sheets * sheetArea) if sheets else 0.0
+
+
+def packGroup(group: SheetGroup, sheetLength, sheetWidth, kerf=0.0) -> PackingResult:
+    """ First-fit decreasing shelf packing. Parts lie with their long side along the sheet's length and fill shelves
+    across it; every cut runs the full length or width of a shelf, so the layouts can be cut with a panel saw. Parts
+    too large for a sheet are counted as oversized and left out of the yield. """
+    sheetLength, sheetWidth = max(sheetLength, sheetWidth), min(sheetLength, sheetWidth)
+    # Each part takes a kerf on one side; the sheet gets one more so the last part needs no cut at the edge
+    usableLength = sheetLength + kerf
+    usableWidth = sheetWidth + kerf
+    lengths, widths, counts = group.Lengths, group.Widths, group.Counts
+
+    sheets = FirstFitTree()
+    shelves = FirstFitTree()
+    oversized = 0
+    partArea = 0.0
+    # Tallest shelves first, so every open shelf is tall enough for the parts that follow
+    order = sorted(range(len(counts)), key=lambda i: (widths[i], lengths[i]), reverse=True)
+    for i in order:
+        length = lengths[i] + kerf
+        width = widths[i] + kerf
+        count = counts[i]
+        if length > usableLength or width > usableWidth:
+            oversized += count
+            continue
+        partArea += lengths[i] * widths[i] * count
+        while count:
+            shelf = shelves.find(length - 1e-9)
+            if shelf < 0:
+                sheet = sheets.find(width - 1e-9)
+                if sheet < 0:
+                    sheet = sheets.append(usableWidth)
+                sheets.update(sheet, sheets[sheet] - width)
+                shelf = shelves.append(usableLength)
+            # Identical parts fill the shelf together
+            room = shelves[shelf]
+            placed = min(count, max(1, int((room + 1e-9) // length)))
+            shelves.update(shelf, room - placed * length)
+            count -= placed
+    return PackingResult(sheets.count, oversized, partArea, sheetLength * sheetWidth)
+
+
+def groupParts(bom, thicknessTolerance=1e-4) -> list:
+    """ SheetGroups in first-seen order, keyed on material and thickness (the smallest dimension) """
+    groups = {}
+    for item in bom:
+        # Removed parts have nothing left to cut
+        if getattr(item, "Change", None) == Core.BomDelta.Removed:
+            continue
+        dims = item.PhysicalAttributes.Dimensions
+        length, width, thickness = dims.GetSortedInternal()
+        material = item.PhysicalAttributes.Material
+        key = (material, round(thickness / thicknessTolerance))
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = SheetGroup(material, thickness, dims.GetSortedFormatted()[2])
+        group.add(length, width, item.Quantity)
+    return list(groups.values())
+
+
+def WriteSheetYield(helper, stream, bom, prefs, useFractions=None):
+    """ One row per material and thickness with the estimated sheet count and yield """
+    decimalPoint = ',' if prefs.useCommaDecimal else '.'
+    writer = csv.writer(stream)
+    writer.writerow(["Material", "Thickness {}".format(prefs.lengthUnitString), "Parts", "Sheets", "Yield %",
+        "Part area cm^2", "Oversized parts"])
+    for group in groupParts(bom):
+        result = packGroup(group, prefs.sheetLength, prefs.sheetWidth, prefs.sawKerf)
+        writer.writerow([group.Material, group.ThicknessFormatted, group.partCount(), result.Sheets,
+            "{0:.1f}".format(result.Yield * 100).replace('.', decimalPoint),
+            "{0:.2f}".format(result.PartArea).replace('.', decimalPoint), result.Oversized])
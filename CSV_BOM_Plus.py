@@ -4,15 +4,11 @@
 
 import adsk.core
 import adsk.fusion
-import adsk.cam
-import collections
-import traceback
 import json
-import re
+import traceback
 from . import CSV_BOM_Core as Core
 # import CSV_BOM_Core as Core
 # from CSV_BOM_Core import Helper, Dimensions, PhysicalAttributes, BomItem
-from typing import List
 
 # Global list to keep all event handlers in scope.
 # This is only needed with Python.
@@ -24,6 +20,14 @@ cmdName = "CSV-BOM Plus"
 dialogTitle = "Create BOM"
 cmdDesc = "Creates a bill of material and a cutlist from the browser components."
 cmdRes = ".//resources//CSV-BOM"
+# Fired from the export thread once the files are written
+exportDoneEventId = "CSVBomPlusExportDone"
+# Running exports by id, with their design, until the export done event saves their state
+pendingExports = {}
+
+def saveDesignAttributes(design, attributes):
+    for name, value in attributes.items():
+        design.attributes.add(cmdId, name, value)
 
 # Event handler for the commandCreated event.
 class BOMCommandCreatedEventHandler(adsk.core.CommandCreatedEventHandler):
@@ -51,11 +55,12 @@ class BOMCommandCreatedEventHandler(adsk.core.CommandCreatedEventHandler):
         # Configure command inputs UI
         
         # Select output file format
-        ipOutputFormat = inputs.addDropDownCommandInput("outputFormat", "Output File Format", adsk.core.DropDownStyles.TextListDropDownStyle)
-        # TODO - use reflection to identify all formatters
+        # Several formats may be checked; they are all written from a single walk of the design
+        ipOutputFormat = inputs.addDropDownCommandInput("outputFormat", "Output File Format", adsk.core.DropDownStyles.CheckBoxDropDownStyle)
+        savedFormats = prefs.GetOutputFormats()
         for outputFormat in Core.OutputFormats.all.keys():
-            # If the saved output format == the one we are adding to the list, select it
-            selected = prefs.outputFormat==outputFormat
+            # If the saved output formats include the one we are adding to the list, select it
+            selected = outputFormat in savedFormats
             ipOutputFormat.listItems.add(outputFormat, selected, '')
             
         ipSelectComps = inputs.addBoolValueInput("onlySelectedComponents", "Selected only", True, "", prefs.onlySelectedComponents)
@@ -85,12 +90,69 @@ class BOMCommandCreatedEventHandler(adsk.core.CommandCreatedEventHandler):
         ipUseQuantity = inputs.addBoolValueInput("useQuantity", "Use quantity field", True, "", prefs.useQuantity)
         ipUseQuantity.tooltip = "Use a quantity field; otherwise output one row per repeated component."
 
+        ipAccuracy = inputs.addDropDownCommandInput("boundingBoxAccuracy", "Bounding box accuracy", adsk.core.DropDownStyles.TextListDropDownStyle)
+        for accuracy in Core.BoundingBoxAccuracy.all:
+            ipAccuracy.listItems.add(accuracy, prefs.boundingBoxAccuracy == accuracy, '')
+        ipAccuracy.tooltip = "Automatic uses Fusion's bounding box for plain box shaped bodies and only meshes the others. Fast never meshes; Tight uses the display mesh; Tolerance calculates a mesh at the given tolerance."
+
+        ipMeshTolerance = inputs.addValueInput("meshTolerance", "Mesh tolerance", design.fusionUnitsManager.defaultLengthUnits, adsk.core.ValueInput.createByReal(prefs.meshTolerance))
+        ipMeshTolerance.tooltip = "Surface tolerance of the calculated mesh when the accuracy is Tolerance."
+
+        ipSheetLength = inputs.addValueInput("sheetLength", "Sheet length", design.fusionUnitsManager.defaultLengthUnits, adsk.core.ValueInput.createByReal(prefs.sheetLength))
+        ipSheetLength.tooltip = "Length of the stock sheets for the sheet yield estimate."
+        ipSheetWidth = inputs.addValueInput("sheetWidth", "Sheet width", design.fusionUnitsManager.defaultLengthUnits, adsk.core.ValueInput.createByReal(prefs.sheetWidth))
+        ipSheetWidth.tooltip = "Width of the stock sheets for the sheet yield estimate."
+        ipSawKerf = inputs.addValueInput("sawKerf", "Saw kerf", design.fusionUnitsManager.defaultLengthUnits, adsk.core.ValueInput.createByReal(prefs.sawKerf))
+        ipSawKerf.tooltip = "Material lost to each cut in the sheet yield estimate."
+
+        ipCompress = inputs.addBoolValueInput("compressOutput", "Compress (gzip)", True, "", prefs.compressOutput)
+        ipCompress.tooltip = 'Writes gzip compressed files with ".gz" appended to the filename, for very large exports.'
+
+        ipGroupParts = inputs.addBoolValueInput("groupIdenticalParts", "Group identical parts", True, "", prefs.groupIdenticalParts)
+        ipGroupParts.tooltip = 'Merges differently named components (e.g. "Shelf (1)" and "Shelf v2") with the same dimensions and material into one row.'
+
+        ipRollup = inputs.addBoolValueInput("materialRollup", "Material rollup", True, "", prefs.materialRollup)
+        ipRollup.tooltip = 'Also writes "<file> - Material_rollup.csv" with the part count, area, volume and mass per material and thickness.'
+
+        ipSkipUnchanged = inputs.addBoolValueInput("skipUnchanged", "Skip unchanged exports", True, "", prefs.skipUnchanged)
+        ipSkipUnchanged.tooltip = 'Leaves the files (and their timestamps) alone when they would be written with the same content as last time.'
+
+        ipDeltaExport = inputs.addBoolValueInput("deltaExport", "Only changes since last export", True, "", prefs.deltaExport)
+        ipDeltaExport.tooltip = "Only write the parts that were added, removed or changed since the last export, with a Change column."
+
+        ipProfile = inputs.addBoolValueInput("profileExport", "Write timing profile", True, "", prefs.profileExport)
+        ipProfile.tooltip = 'Records time and API calls per export phase and writes them to "<file>.profile.json" next to the exported file.'
+
+        ipCProfile = inputs.addBoolValueInput("profileWithCProfile", "Include cProfile dump", True, "", prefs.profileWithCProfile)
+        ipCProfile.tooltip = 'Also writes a Python cProfile dump to "<file>.prof" when writing a timing profile.'
+
         # Connect to the execute event.
         onExecute = BOMCommandExecuteHandler()
         cmd.execute.add(onExecute)
         handlers.append(onExecute)
 
 
+# Event handler for the export done custom event, back on the UI thread.
+class BOMExportDoneEventHandler(adsk.core.CustomEventHandler):
+    def __init__(self):
+        super().__init__()
+
+    def notify(self, args):
+        try:
+            result = json.loads(args.additionalInfo)
+            design, export = pendingExports.pop(result["exportId"], (None, None))
+            # The caches only move on to this BOM once its files are written
+            if not result["error"] and design and design.isValid:
+                saveDesignAttributes(design, export.state)
+            if result["error"]:
+                ui.messageBox('Failed:\n{}'.format(result["error"]), dialogTitle)
+            else:
+                ui.messageBox('File written to "' + '", "'.join(result["filenames"]) + '"')
+        except:
+            if ui:
+                ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
+
+
 # Event handler for the execute event.
 class BOMCommandExecuteHandler(adsk.core.CommandEventHandler):
     global cmdId
@@ -103,7 +165,10 @@ class BOMCommandExecuteHandler(adsk.core.CommandEventHandler):
         prefDict = {}
         for i in range(inputs.count):
             commandInput = inputs.item(i)
-            if 'selectedItem' in dir(commandInput):
+            if commandInput.id == "outputFormat":
+                # Check box drop down: every checked format
+                prefDict[commandInput.id] = [item.name for item in commandInput.listItems if item.isSelected]
+            elif 'selectedItem' in dir(commandInput):
                 # Drop down or similar
                 prefDict[commandInput.id] = commandInput.selectedItem.name
             else:
@@ -111,119 +176,45 @@ class BOMCommandExecuteHandler(adsk.core.CommandEventHandler):
                 prefDict[commandInput.id] = commandInput.value
         return Core.CsvBomPrefs(**prefDict)
 
-    def getBodiesVolume(self, bodies):
-        volume = 0
-        for bodyK in bodies:
-            if bodyK.isSolid:
-                volume += bodyK.volume
-        return volume
-
-    # Calculates a tight bounding box around the input body.  An optional
-    # tolerance argument is available.  This specificies the tolerance in
-    # centimeters.  If not provided the best existing display mesh is used.
-    def calculateTightBoundingBox(self, body, tolerance=0):
-        try:
-            # If the tolerance is zero, use the best display mesh available.
-            if tolerance <= 0:
-                # Get the best display mesh available.
-                triMesh = body.meshManager.displayMeshes.bestMesh
-            else:
-                # Calculate a new mesh based on the input tolerance.
-                meshMgr = adsk.fusion.MeshManager.cast(body.meshManager)
-                meshCalc = meshMgr.createMeshCalculator()
-                meshCalc.surfaceTolerance = tolerance
-                triMesh = meshCalc.calculate()
-
-            # Calculate the range of the mesh.
-            smallPnt = adsk.core.Point3D.cast(triMesh.nodeCoordinates[0])
-            largePnt = adsk.core.Point3D.cast(triMesh.nodeCoordinates[0])
-            vertex = adsk.core.Point3D.cast(None)
-            for vertex in triMesh.nodeCoordinates:
-                if vertex.x < smallPnt.x:
-                    smallPnt.x = vertex.x
-
-                if vertex.y < smallPnt.y:
-                    smallPnt.y = vertex.y
-
-                if vertex.z < smallPnt.z:
-                    smallPnt.z = vertex.z
-
-                if vertex.x > largePnt.x:
-                    largePnt.x = vertex.x
-
-                if vertex.y > largePnt.y:
-                    largePnt.y = vertex.y
-
-                if vertex.z > largePnt.z:
-                    largePnt.z = vertex.z
+    def loadComponentCache(self, design) -> Core.ComponentCache:
+        cacheAttr = design.attributes.itemByName(cmdId, "componentCache")
+        if cacheAttr:
+            try:
+                return Core.ComponentCache.from_json(cacheAttr.value)
+            except:
+                pass
+        return Core.ComponentCache()
 
-            # Create and return a BoundingBox3D as the result.
-            return(adsk.core.BoundingBox3D.create(smallPnt, largePnt))
-        except:
-            # An error occurred so return None.
-            return None
-
-    def getBodiesBoundingBox(self, bodies):
-        minPointX = maxPointX = minPointY = maxPointY = minPointZ = maxPointZ = 0
-        # Examining the maximum min point distance and the maximum max point distance.
-        for body in bodies:
-            if body.isSolid:
-                bb = self.calculateTightBoundingBox(body, 0)
-                if not bb:
-                    return None
-                if not minPointX or bb.minPoint.x < minPointX:
-                    minPointX = bb.minPoint.x
-                if not maxPointX or bb.maxPoint.x > maxPointX:
-                    maxPointX = bb.maxPoint.x
-                if not minPointY or bb.minPoint.y < minPointY:
-                    minPointY = bb.minPoint.y
-                if not maxPointY or bb.maxPoint.y > maxPointY:
-                    maxPointY = bb.maxPoint.y
-                if not minPointZ or bb.minPoint.z < minPointZ:
-                    minPointZ = bb.minPoint.z
-                if not maxPointZ or bb.maxPoint.z > maxPointZ:
-                    maxPointZ = bb.maxPoint.z
-        return {
-            "x": maxPointX - minPointX,
-            "y": maxPointY - minPointY,
-            "z": maxPointZ - minPointZ
-        }
-
-    def getPhysicsArea(self, bodies):
-        area = 0
-        for body in bodies:
-            if body.isSolid:
-                if body.physicalProperties:
-                    area += body.physicalProperties.area
-        return area
-
-    def getPhysicalMass(self, bodies):
-        mass = 0
-        for body in bodies:
-            if body.isSolid:
-                if body.physicalProperties:
-                    mass += body.physicalProperties.mass
-        return mass
-
-    def getPhysicalDensity(self, bodies):
-        density = 0
-        if bodies.count > 0:
-            body = bodies.item(0)
-            if body.isSolid:
-                if body.physicalProperties:
-                    density = body.physicalProperties.density
-            return density
-
-    def getPhysicalMaterial(self, bodies):
-        matList = []
-        for body in bodies:
-            if body.isSolid and body.material:
-                mat = body.material.name
-                if mat not in matList:
-                    matList.append(mat)
-        return ', '.join(matList)
-
-    
+    def loadBomDelta(self, design) -> Core.BomDelta:
+        snapshotAttr = design.attributes.itemByName(cmdId, "lastBomSnapshot")
+        if snapshotAttr:
+            try:
+                return Core.BomDelta.from_json(snapshotAttr.value)
+            except:
+                pass
+        return Core.BomDelta()
+
+    def reportProgress(self, progressDialog, progress: Core.ExportProgress):
+        """ ExportProgress callback: show the per-phase counts, keep the UI responsive and honour the cancel button """
+        counts = progress.counts
+        progressDialog.message = 'Occurrences scanned: {}\nUnique components: {} of {}\nRows prepared: {}'.format(
+            counts[Core.ExportProgress.Occurrences], counts[Core.ExportProgress.Components], progress.total, counts[Core.ExportProgress.Rows])
+        if progress.total:
+            progressDialog.maximumValue = progress.total
+            progressDialog.progressValue = counts[Core.ExportProgress.Components]
+        adsk.doEvents()
+        if progressDialog.wasCancelled:
+            raise Core.ExportCancelledError()
+
+    def exportComplete(self, export: Core.BackgroundExport, profiler: Core.Profiler):
+        """ Called on the export thread; only firing the custom event touches the Fusion API """
+        error = export.traceback
+        if not error and export.prefs.profileExport:
+            try:
+                profiler.WriteSidecar(export.filename)
+            except:
+                error = traceback.format_exc()
+        app.fireCustomEvent(exportDoneEventId, json.dumps({"exportId": id(export), "filenames": export.filenames, "error": error}))
 
     def notify(self, args):
         global app
@@ -231,6 +222,9 @@ class BOMCommandExecuteHandler(adsk.core.CommandEventHandler):
         global dialogTitle
         global cmdId
 
+        # The walker (and the geometry code behind it) is only needed once an export runs
+        from . import CSV_BOM_Walker as Walker
+
         product = app.activeProduct
         design = adsk.fusion.Design.cast(product)
         eventArgs = adsk.core.CommandEventArgs.cast(args)
@@ -240,14 +234,22 @@ class BOMCommandExecuteHandler(adsk.core.CommandEventHandler):
             ui.messageBox('No active design', dialogTitle)
             return
 
+        progressDialog = None
         try:
             prefs = self.getPrefsObject(inputs)
+            if not prefs.GetOutputFormats():
+                ui.messageBox('No output format selected!\nPlease select at least one output format.')
+                return
             preferredUnits = design.fusionUnitsManager.defaultLengthUnits
             prefs.lengthUnitString = preferredUnits
             # enum : http://help.autodesk.com/view/fusion360/ENU/?guid=GUID-cb53a403-d687-4016-aae6-b03f095bdb61
             # preferredUnits = design.fusionUnitsManager.distanceDisplayUnits
             
-            # Get all occurrences in the root component of the active design
+            cache = self.loadComponentCache(design)
+            profiler = Core.Profiler(enabled=prefs.profileExport)
+            walker = Walker.BomWalker(design, prefs, preferredUnits, cache, profiler=profiler)
+
+            # Get the top level occurrences to walk: those of the root component, or the selected ones
             root = design.rootComponent
             occs = []
             if prefs.onlySelectedComponents:
@@ -256,17 +258,16 @@ class BOMCommandExecuteHandler(adsk.core.CommandEventHandler):
                     for selection in selections:
                         if (hasattr(selection.entity, "objectType") and selection.entity.objectType == adsk.fusion.Occurrence.classType()):
                             occs.append(selection.entity)
-                            if selection.entity.component:
-                                for item in selection.entity.component.allOccurrences:
-                                    occs.append(item)
                         else:
                             ui.messageBox('No components selected!\nPlease select some components.')
                             return
                 else:
                     ui.messageBox('No components selected!\nPlease select some components.')
                     return
+                # Overlapping selections would otherwise be counted twice
+                occs = walker.topmostOccurrences(occs)
             else:
-                occs = root.allOccurrences
+                occs = root.occurrences
 
             if len(occs) == 0:
                 ui.messageBox('In this design there are no components.')
@@ -276,7 +277,7 @@ class BOMCommandExecuteHandler(adsk.core.CommandEventHandler):
             fileDialog = ui.createFileDialog()
             fileDialog.isMultiSelectEnabled = False
             fileDialog.title = dialogTitle + " filename"
-            fileDialog.filter = 'CSV (*.csv);;TXT (*.txt);;All Files (*.*)'
+            fileDialog.filter = 'CSV (*.csv);;TXT (*.txt);;SQLite (*.sqlite);;All Files (*.*)'
             fileDialog.filterIndex = 0
             dialogResult = fileDialog.showSave()
             if dialogResult == adsk.core.DialogResults.DialogOK:
@@ -284,68 +285,75 @@ class BOMCommandExecuteHandler(adsk.core.CommandEventHandler):
             else:
                 return
 
-            # Gather information about each unique component
-            bom = [] # type: List[Core.BomItem]
-            # Loop through every component in the design
-            for occ in occs:
-                comp = occ.component
-                # TODO - move _ strip logic here
-                if comp.name.startswith('_') and prefs.ignoreUnderscorePrefixedComponents:
-                    continue
-                elif prefs.ignoreLinkedComponents and design != comp.parentDesign:
-                    continue
-                elif not comp.bRepBodies.count and prefs.ignoreCompWoBodies:
-                    continue
-                elif not occ.isVisible and prefs.ignoreVisibleState is False:
-                    continue
-                else:
-                    jj = 0
-                    for bomI in bom:
-                        # If we have encountered this component already, simply increment the count
-                        if bomI.Component == comp:
-                            # Increment the instance count of the existing row.
-                            bomI.Quantity += 1
-                            break
-                        jj += 1
-
-                    if jj == len(bom):
-                        # Add this component to the BOM
-                        bb = self.getBodiesBoundingBox(comp.bRepBodies)
-                        if not bb:
-                            if ui:
-                                ui.messageBox('Not all Fusion modules are loaded yet, please click on the root component to load them and try again.')
-                            return
+            # Work in chunks, reporting progress and letting Fusion process events (and the cancel button) in between
+            progressDialog = ui.createProgressDialog()
+            progressDialog.isCancelButtonShown = True
+            progressDialog.show(dialogTitle, 'Scanning occurrences', 0, 1, 0)
+            walker.progress = Core.ExportProgress(lambda progress: self.reportProgress(progressDialog, progress))
 
-                        bom.append(Core.BomItem(
-                            comp.name,
-                            1, 
-                            comp.description,
-                            Core.PhysicalAttributes(
-                                Core.Dimensions( #Dimensions are x,y,z numeric internal units (cm) and string-formatted per the model & user preferences
-                                    bb['x'],
-                                    bb['y'],
-                                    bb['z'],
-                                    # http://help.autodesk.com/view/fusion360/ENU/?guid=GUID-40dda15b-8dec-4122-b0fa-cbd604cd35b
-                                    design.fusionUnitsManager.formatInternalValue(bb['x'], preferredUnits, False),
-                                    design.fusionUnitsManager.formatInternalValue(bb['y'], preferredUnits, False),
-                                    design.fusionUnitsManager.formatInternalValue(bb['z'], preferredUnits, False)
-                                ),
-                                self.getBodiesVolume(comp.bRepBodies),
-                                self.getPhysicsArea(comp.bRepBodies),
-                                self.getPhysicalMass(comp.bRepBodies),
-                                self.getPhysicalDensity(comp.bRepBodies),
-                                self.getPhysicalMaterial(comp.bRepBodies)
-                            ),
-                            comp
-                        ))
-            # Pass the BOM to the file Writer
-            helper = Core.Helper()
-            helper.SaveFile(filename, bom, prefs)
+            pythonProfile = None
+            if prefs.profileExport and prefs.profileWithCProfile:
+                import cProfile
+                pythonProfile = cProfile.Profile()
+                pythonProfile.enable()
+
+            try:
+                # Count each unique component first; this touches no geometry and is cheap
+                bom = walker.countComponents(occs)
+
+                # Stream the BOM to the file writer. Geometry and physical properties are gathered
+                #  per component as the writer consumes each row.
+                helper = Core.Helper(profiler)
+                formatter = walker.getLengthFormatter()
+                if formatter is not None:
+                    useFractions = bool(formatter.FractionDenominator)
+                else:
+                    # 1.27cm is 1/2 inch; it only formats with a "/" when the user displays fractional inches
+                    useFractions = '/' in design.fusionUnitsManager.formatInternalValue(1.27, preferredUnits, False)
+                # Compare against (or just record) the snapshot of the last exported BOM
+                delta = self.loadBomDelta(design)
+                keyedItems = ((item.Component.entityToken, item) for item in walker.generateBomItems(bom))
+                if prefs.deltaExport:
+                    items = delta.changes(keyedItems)
+                else:
+                    items = delta.record(keyedItems)
+                # Counted as the snapshot takes each row; nothing is written until the worker thread starts
+                items = walker.progress.track(items, Core.ExportProgress.Rows)
+                # Take a snapshot of the BOM here, on the UI thread; the files are written on a worker thread
+                export = Core.BackgroundExport(helper, filename, items, prefs, useFractions,
+                    onComplete=lambda export: self.exportComplete(export, profiler))
+            except Walker.ModulesNotLoadedError:
+                progressDialog.hide()
+                if ui:
+                    ui.messageBox('Not all Fusion modules are loaded yet, please click on the root component to load them and try again.')
+                return
+            except Core.ExportCancelledError:
+                # Nothing has been written yet
+                progressDialog.hide()
+                ui.messageBox('Export cancelled, no file was written.')
+                return
+            finally:
+                if pythonProfile:
+                    pythonProfile.disable()
+            progressDialog.hide()
+
+            if pythonProfile:
+                # The Python profile covers the walk on this thread
+                pythonProfile.dump_stats(filename + ".prof")
             
-            # Save last chosen options
+            # Save last chosen options for the next export. The geometry cache and the delta baseline are saved
+            #  by the export done event, and only if the files were written.
             design.attributes.add(cmdId, "lastUsedOptions", prefs.to_json())
-            ui.messageBox('File written to "' + filename + '"')
+            export.state = {"componentCache": cache.to_json(), "lastBomSnapshot": delta.to_json()}
+            if export.unchanged:
+                # Not written and not reported: the files from the last export already match this BOM
+                saveDesignAttributes(design, export.state)
+                return
+            pendingExports[id(export)] = (design, export)
+            export.start()
         except:
+            if progressDialog:
+                progressDialog.hide()
             if ui:
                 ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
 
@@ -368,6 +376,12 @@ def run(context):
         bomButton.commandCreated.add(commandCreated)
         handlers.append(commandCreated)
 
+        # Background exports report back through a custom event
+        exportDone = app.registerCustomEvent(exportDoneEventId)
+        onExportDone = BOMExportDoneEventHandler()
+        exportDone.add(onExportDone)
+        handlers.append(onExportDone)
+
         # Get the ADD-INS panel in the model workspace.
         toolbarPanel = ui.allToolbarPanels.itemById("SolidCreatePanel")
 
@@ -394,6 +408,8 @@ def stop(context):
         cntrl = toolbarPanel.controls.itemById(cmdId)
         if cntrl:
             cntrl.deleteMe()
+
+        app.unregisterCustomEvent(exportDoneEventId)
     except:
         if ui:
             ui.messageBox("Failed:\n{}".format(traceback.format_exc()))
@@ -1,9 +1,17 @@
 import collections
+import gzip
 import io
 import os
 import sys
+import tempfile
+import json
 import unittest
 import CSV_BOM_Core as Core
+import CSV_BOM_Geometry as Geometry
+import CSV_BOM_Benchmark as Benchmark
+import CSV_BOM_Headless as Headless
+import CSV_BOM_Packing as Packing
+import CSV_BOM_Walker as Walker
 # from . import CSV_BOM_Core as Core
 # from CSV_BOM_Core import BomItem, PhysicalAttributes, Dimensions, Helper
 
@@ -43,6 +51,653 @@ class MyTest(unittest.TestCase):
                 "Water"
             ))
 
+    def getBomItem(self, name, quantity=1, dims=(1.0, 2.0, 3.0), formatted=None, volume=6.0, area=22.0, mass=0.5,
+            density=0.1, material="Oak", description=""):
+        """ A BomItem with plain values; dimensions are formatted with "{:g}" unless given """
+        formatted = formatted or ["{:g}".format(d) for d in dims]
+        return Core.BomItem(name, quantity, description,
+            Core.PhysicalAttributes(Core.Dimensions(*dims, *formatted), volume, area, mass, density, material))
+
+    def test_bomAccumulator(self):
+        bom = Core.BomAccumulator()
+        first = self.getDefaultBom()
+        second = Core.BomItem("Second", 1, "", first.PhysicalAttributes)
+
+        assert not bom.increment("a")
+        bom.add("a", first)
+        bom.add("b", second)
+        assert bom.increment("a")
+        assert bom.increment("b", 3)
+
+        assert len(bom) == 2
+        assert "a" in bom
+        assert bom.get("a") is first
+        assert [i.Name for i in bom] == ["My component name", "Second"]
+        assert first.Quantity == 3
+        assert second.Quantity == 4
+
+    def test_boundsFromCoordinates(self):
+        coords = [1, 2, 3,  -1, 5, 0,  4, -2, 7]
+        b = Geometry.boundsFromCoordinates(coords)
+        assert b == (-1, -2, 0, 4, 5, 7)
+        assert Geometry.boundsFromCoordinates([]) is None
+
+        # Bodies entirely on the negative side must not be clipped to zero
+        u = Geometry.unionBounds([(-5, -5, -5, -3, -3, -3), (-4, -6, -4, -2, -4, -1)])
+        assert u == (-5, -6, -5, -2, -3, -1)
+        assert Geometry.boundsSize(u) == {"x": 3, "y": 3, "z": 4}
+        assert Geometry.boundsSize(None) == {"x": 0, "y": 0, "z": 0}
+
+    def test_componentCache(self):
+        cache = Core.ComponentCache(maxEntries=2)
+        cache.put("a", "rev1", {"x": 1})
+        cache.put("b", "rev1", {"x": 2})
+        assert cache.get("a", "rev1") == {"x": 1}
+        # Stale fingerprint is a miss
+        assert cache.get("b", "rev2") is None
+        # "b" is least recently used and is evicted
+        cache.put("c", "rev1", {"x": 3})
+        assert cache.get("b", "rev1") is None
+        assert len(cache) == 2
+        assert cache.hits == 1
+        assert cache.misses == 2
+
+        restored = Core.ComponentCache.from_json(cache.to_json())
+        assert restored.get("c", "rev1") == {"x": 3}
+        assert restored.get("a", "rev1") == {"x": 1}
+
+    def test_componentCache_largeDesign(self):
+        # More components than maxEntries, visited in the same order by every export
+        snapshot = {"rootComponent": "root", "components": {"root": {"name": "Root", "occurrences": []}}}
+        for i in range(30):
+            token = "part{}".format(i)
+            snapshot["components"][token] = {"name": token, "revisionId": "1", "bodies": [{"boundingBox": [0, 0, 0, 1, 2, 3]}]}
+            snapshot["components"]["root"]["occurrences"].append({"component": token})
+        design = Headless.StandInDesign(snapshot)
+        cache = Core.ComponentCache(maxEntries=10)
+        for export in range(3):
+            cache = Core.ComponentCache.from_json(cache.to_json(), maxEntries=10)
+            walker = Walker.BomWalker(design, Core.CsvBomPrefs(), "mm", cache)
+            list(walker.generateBomItems(walker.countComponents(design.rootComponent.occurrences)))
+        # Only the first export misses
+        self.assertEqual((cache.hits, cache.misses), (30, 0))
+        self.assertEqual(len(cache), 30)
+
+    def test_bomTable(self):
+        # Numeric columns are stored as doubles, as Fusion reports them. Components without solid bodies have an
+        #  int volume of 0, which is written as "0".
+        items = [Core.BomItem("My component name", 2, "Desc", Core.PhysicalAttributes(Core.Dimensions(3.0, 4.0, 5.0, "3", "4", "5"), 60.0, 20.0, 60.0, 1.0, "Water")),
+            Core.BomItem("Tie", 1, "", Core.PhysicalAttributes(Core.Dimensions(2.0, 7.0, 2.0, "2a", "7", "2b"), 0, 2.0, 3.0, 4.0, "Oak"))]
+        table = Core.BomTable.from_items(items)
+        assert len(table) == 2
+
+        for item, row in zip(items, table):
+            assert row.GetSortedTuples() == item.PhysicalAttributes.Dimensions.GetSortedTuples()
+            assert row.GetSortedInternal() == item.PhysicalAttributes.Dimensions.GetSortedInternal()
+            assert row.PhysicalAttributes.Dimensions.GetSortedFormatted() == item.PhysicalAttributes.Dimensions.GetSortedFormatted()
+            assert row.GetUnsortedFormatted() == item.PhysicalAttributes.Dimensions.GetUnsortedFormatted()
+
+        # Writers produce the same output from the table as from the items
+        h = Core.Helper()
+        for prefs in [Core.CsvBomPrefs(lengthUnitString="mm"), Core.CsvBomPrefs(useQuantity=False, sortDimensions=False)]:
+            expected = io.StringIO(newline='')
+            actual = io.StringIO(newline='')
+            template = h.ParseCsvTemplate(prefs, Core.OutputFormats.FullCsvTemplate)
+            h.WriteCsvFromTemplate(expected, items, prefs, template)
+            h.WriteCsvFromTemplate(actual, table, prefs, template)
+            h.WriteCutlistGaryDarby(expected, items, prefs)
+            h.WriteCutlistGaryDarby(actual, table, prefs)
+            self.assertEqual(actual.getvalue(), expected.getvalue())
+
+        table[0].Quantity += 1
+        assert table.Quantities[0] == 3
+
+        # Background export snapshots are tables without components, keeping delta changes
+        items[1].Component = object()
+        snapshot = h.SnapshotBom([items[0], Core.BomChange(Core.BomDelta.Removed, items[1])])
+        assert isinstance(snapshot, Core.BomTable)
+        self.assertEqual([(row.Change, row.Component) for row in snapshot], [(None, None), (Core.BomDelta.Removed, None)])
+        # The rows of one table, streamed in order as the walker yields them, share its columns
+        table = Core.BomTable.from_items(items)
+        snapshot = h.SnapshotBom(row for row in table)
+        assert snapshot.Names is table.Names and snapshot.DimensionsInternal is table.DimensionsInternal
+        self.assertEqual(snapshot.Components, [None, None])
+        assert table.Components[1] is items[1].Component
+        # Rows out of order are copied
+        snapshot = h.SnapshotBom([table[1], table[0]])
+        assert snapshot.Names is not table.Names
+        self.assertEqual([row.Name for row in snapshot], ["Tie", "My component name"])
+
+    def test_benchmark(self):
+        bom = Benchmark.generateBom(10, uniqueParts=5, fractional=True)
+        assert len(bom) == 10
+        assert bom[0].Name == "Part 0" and bom[5].Name == "Part 0"
+
+        results = Benchmark.runBenchmarks([20], memory=False)
+        assert "Cutlist (Gary Darby) [20]" in results
+        results = Benchmark.runBenchmarks([20], memory=False, uniqueParts=5)
+        assert "Cutlist (Gary Darby) [20 5 unique]" in results
+
+        baseline = {"case": {"rows": 10, "rowsPerSec": 1000, "peakBytes": 100}}
+        assert Benchmark.compareResults({"case": {"rows": 10, "rowsPerSec": 900, "peakBytes": 110}}, baseline) == []
+        assert len(Benchmark.compareResults({"case": {"rows": 10, "rowsPerSec": 500, "peakBytes": 200}}, baseline)) == 2
+
+    def getSnapshot(self):
+        panel = {"isSolid": True, "volume": 360.0, "area": 1000.0, "mass": 0.25, "density": 0.0007, "material": "Oak"}
+        return {
+            "name": "Cabinet",
+            "defaultLengthUnits": "mm",
+            "rootComponent": "root",
+            "components": {
+                "root": {"name": "Cabinet", "occurrences": [
+                    {"component": "drawer"}, {"component": "drawer"}, {"component": "side"}, {"component": "_jig"}]},
+                "drawer": {"name": "Drawer", "occurrences": [{"component": "side"}, {"component": "hidden", "isVisible": False}]},
+                "side": {"name": "Side (1)", "description": "Left or right", "revisionId": "1",
+                    "bodies": [dict(panel, boundingBox=[0, 0, 0, 1.8, 40, 5])]},
+                "hidden": {"name": "Hidden", "bodies": [dict(panel, mesh=[0, 0, 0, 1, 2, 3, -1, 0, 0])]},
+                "_jig": {"name": "_jig", "bodies": [panel]}
+            }
+        }
+
+    def test_headlessExport(self):
+        design = Headless.StandInDesign(self.getSnapshot())
+        prefs = Core.CsvBomPrefs(ignoreVisibleState=False)
+        with tempfile.TemporaryDirectory() as outputDir:
+            filenames = Headless.exportDesign(design, outputDir, [Core.OutputFormats.FullCsv, Core.OutputFormats.GaryDarby], prefs)
+            assert len(filenames) == 2
+            with open(filenames[0], newline='') as f:
+                lines = f.read().splitlines()
+            self.assertEqual(lines, [
+                "Part name,Quantity,Volume cm^3,Width mm,Length mm,Height mm,Area cm^2,Mass kg,Density kg/cm^2,Material,Description",
+                "Side,3,360.0,400,50,18,1000.00,0.25000,0.00070,Oak,Left or right"])
+
+            # The same snapshot through the process pool
+            path = os.path.join(outputDir, "cabinet.json")
+            with open(path, 'w') as f:
+                json.dump(self.getSnapshot(), f)
+            results = Headless.exportMany([path], outputDir, [Core.OutputFormats.FullCsv], Core.CsvBomPrefs(), processes=1)
+            with open(results[path][0], newline='') as f:
+                lines = f.read().splitlines()
+            self.assertEqual(len(lines), 3)
+
+    def test_backgroundExportWithoutBodies(self):
+        snapshot = self.getSnapshot()
+        snapshot["components"]["root"]["occurrences"].append({"component": "empty"})
+        snapshot["components"]["empty"] = {"name": "Empty"}
+        design = Headless.StandInDesign(snapshot)
+        prefs = Core.CsvBomPrefs(ignoreCompWoBodies=False, lengthUnitString="mm",
+            outputFormat=[Core.OutputFormats.FullCsv, Core.OutputFormats.GaryDarby])
+        walker = Walker.BomWalker(design, prefs, "mm")
+        bom = walker.countComponents(design.rootComponent.occurrences)
+        with tempfile.TemporaryDirectory() as outputDir:
+            export = Core.BackgroundExport(Core.Helper(), os.path.join(outputDir, "bom.csv"), walker.generateBomItems(bom), prefs)
+            export.start().join(10)
+            assert export.error is None and len(export.filenames) == 2
+            with open(export.filenames[0], newline='') as f:
+                lines = f.read().splitlines()
+            self.assertEqual(lines[-1], "Empty,1,0,0,0,0,0.00,0.00000,0.00000,,")
+
+    def test_lengthFormatter(self):
+        self.assertEqual([Core.LengthFormatter("mm").Format(v) for v in (1.8, 40.0, 0.00001, 1/3)], ["18", "400", "0", "3.333"])
+        self.assertEqual(Core.LengthFormatter("in", 2, decimalPoint=",").Format(2.54 * 1.5), "1,5")
+        fractions = Core.LengthFormatter("in", fractionDenominator=16)
+        self.assertEqual([fractions.Format(2.54 * v) for v in (0.5, 12, 12.3125, 0.01)], ["1/2", "12", "12 5/16", "0"])
+        self.assertEqual(Core.LengthFormatter("ft", 1).Format(45.72), "1.5")
+
+        # Display settings are read from a single API call
+        detected = Core.LengthFormatter.FromUnitsManager(Headless.StandInUnitsManager("in", fractionDenominator=32), "in")
+        self.assertEqual((detected.FractionDenominator, detected.Precision), (32, 3))
+        detected = Core.LengthFormatter.FromUnitsManager(Headless.StandInUnitsManager("cm", precision=2), "cm")
+        self.assertEqual((detected.FractionDenominator, detected.Precision), (0, 2))
+        assert Core.LengthFormatter.FromUnitsManager(Headless.StandInUnitsManager("cm"), "yd") is None
+
+        class CountingUnitsManager(Headless.StandInUnitsManager):
+            calls = 0
+            def formatInternalValue(self, internalValue, units, showUnits=True):
+                CountingUnitsManager.calls += 1
+                return self.format(internalValue, units, showUnits)
+            def format(self, internalValue, units, showUnits):
+                return super().formatInternalValue(internalValue, units, showUnits)
+
+        snapshot = self.getSnapshot()
+        snapshot["components"]["other"] = {"name": "Other", "bodies": [{"isSolid": True, "volume": 1.0, "boundingBox": [0, 0, 0, 1, 2, 3]}]}
+        snapshot["components"]["root"]["occurrences"].append({"component": "other"})
+        design = Headless.StandInDesign(snapshot)
+        design.fusionUnitsManager = CountingUnitsManager("mm")
+        walker = Walker.BomWalker(design, Core.CsvBomPrefs(), "mm")
+        walker.FormatterCheckSamples = 1
+        items = list(walker.generateBomItems(walker.countComponents(design.rootComponent.occurrences)))
+        # One probe, then one checked component; the second component is formatted without the API
+        self.assertEqual(CountingUnitsManager.calls, 4)
+        self.assertEqual(items[-1].PhysicalAttributes.Dimensions.GetUnsortedFormatted(), ["10", "20", "30"])
+
+        # When the API disagrees, its formatting is used for the rest of the export
+        CountingUnitsManager.format = lambda self, value, units, showUnits: "{:.2f}".format(value)
+        walker = Walker.BomWalker(design, Core.CsvBomPrefs(), "mm")
+        items = list(walker.generateBomItems(walker.countComponents(design.rootComponent.occurrences)))
+        self.assertEqual(items[-1].PhysicalAttributes.Dimensions.GetUnsortedFormatted(), ["1.00", "2.00", "3.00"])
+
+    def test_saveFile_multipleFormats(self):
+        bomItem = self.getDefaultBom()
+        prefs = Core.CsvBomPrefs(outputFormat=[Core.OutputFormats.FullCsv, Core.OutputFormats.GaryDarby], lengthUnitString="Inches")
+        h = Core.Helper()
+        with tempfile.TemporaryDirectory() as outputDir:
+            # A generator is consumed once and feeds both writers
+            filenames = h.SaveFile(os.path.join(outputDir, "bom.csv"), (i for i in [bomItem]), prefs)
+            self.assertEqual([os.path.basename(f) for f in filenames], ["bom - Full_CSV_All_properties.csv", "bom - Cutlist_Gary_Darby.txt"])
+            with open(filenames[0]) as f:
+                assert f.read().splitlines()[1].startswith("My component name,2,60,")
+            with open(filenames[1]) as f:
+                assert f.read().count("My component name") == 2
+
+        # Saved prefs from before multiple formats still load
+        assert Core.CsvBomPrefs.from_json('{"outputFormat": "Cutlist (Maxcut)"}').GetOutputFormats() == ["Cutlist (Maxcut)"]
+
+    def test_outputFormatRegistry(self):
+        with tempfile.TemporaryDirectory() as outputDir:
+            with open(os.path.join(outputDir, "CSV_BOM_NamesOnly.py"), "w") as f:
+                f.write("def WriteNames(helper, stream, bom, prefs, useFractions):\n    stream.writelines(item.Name + '\\n' for item in bom)\n")
+            sys.path.insert(0, outputDir)
+            try:
+                Core.OutputFormats.register("Names only", writer="CSV_BOM_NamesOnly:WriteNames", extension=".txt")
+                # Registering does not import the writer
+                assert "CSV_BOM_NamesOnly" not in sys.modules
+                prefs = Core.CsvBomPrefs(outputFormat=["Names only", Core.OutputFormats.FullCsv], lengthUnitString="mm")
+                filenames = Core.Helper().SaveFile(os.path.join(outputDir, "bom.csv"), [self.getDefaultBom()], prefs)
+                self.assertEqual(os.path.basename(filenames[0]), "bom - Names_only.txt")
+                with open(filenames[0]) as f:
+                    self.assertEqual(f.read(), "My component name\n")
+            finally:
+                sys.path.remove(outputDir)
+                sys.modules.pop("CSV_BOM_NamesOnly", None)
+                for registry in (Core.OutputFormats.all, Core.OutputFormats.writers, Core.OutputFormats.extensions, Core.OutputFormats._resolvedWriters):
+                    registry.pop("Names only", None)
+
+    def test_sheetYield(self):
+        item = self.getBomItem
+        bom = [item("Side", 4, (25, 100, 1.8), material="Plywood"), item("Shelf", 3, (24, 50, 1.8), material="Plywood"),
+            item("Back", 1, (10, 120, 0.6), material="Plywood"), item("Top", 1, (20, 50, 1.8)),
+            item("Extra shelf", 1, (24, 50, 1.8), material="Plywood")]
+        groups = Packing.groupParts(bom)
+        self.assertEqual([(g.Material, g.ThicknessFormatted, g.partCount()) for g in groups],
+            [("Plywood", "1.8", 8), ("Plywood", "0.6", 1), ("Oak", "1.8", 1)])
+        # Identical sizes are stored once
+        self.assertEqual(list(groups[0].Counts), [4, 4])
+
+        # A 100 x 50 sheet takes two rows of sides, or two rows of two shelves
+        result = Packing.packGroup(groups[0], 100, 50)
+        self.assertEqual((result.Sheets, result.Oversized), (3, 0))
+        self.assertAlmostEqual(result.Yield, (4 * 100 * 25 + 4 * 50 * 24) / (3 * 100 * 50))
+        # With a kerf only one row of sides fits, and the shelves go one per row beside them
+        self.assertEqual(Packing.packGroup(groups[0], 100, 50, kerf=1).Sheets, 4)
+        self.assertEqual(Packing.packGroup(groups[1], 100, 50).Oversized, 1)
+
+        # Thousands of parts pack quickly through the first-fit trees
+        many = Packing.SheetGroup("Plywood", 1.8, "18")
+        for i in range(10000):
+            many.add(10 + i % 97, 5 + i % 41, 1)
+        result = Packing.packGroup(many, 244, 122, 0.3)
+        assert 0.5 < result.Yield <= 1.0
+
+        prefs = Core.CsvBomPrefs(outputFormat=Core.OutputFormats.SheetYield, lengthUnitString="cm", sheetLength=100, sheetWidth=50, sawKerf=0)
+        with tempfile.TemporaryDirectory() as outputDir:
+            filename = Core.Helper().SaveFile(os.path.join(outputDir, "bom.csv"), bom, prefs)[0]
+            with open(filename, newline='') as f:
+                lines = f.read().splitlines()
+        self.assertEqual(lines[0], "Material,Thickness cm,Parts,Sheets,Yield %,Part area cm^2,Oversized parts")
+        self.assertEqual(lines[1], "Plywood,1.8,8,3,98.7,14800.00,0")
+
+    def test_sqliteExport(self):
+        import sqlite3
+        bomItem = self.getDefaultBom()
+        other = Core.BomItem("_Birch shelf (1)", 3, "", Core.PhysicalAttributes(Core.Dimensions(1.8, 60.0, 30.0, "18", "600", "300"), 3240.0, 4000.0, 2.0, 0.0006, "Birch"))
+        prefs = Core.CsvBomPrefs(outputFormat=[Core.OutputFormats.Sqlite, Core.OutputFormats.FullCsv], useCommaDecimal=True,
+            compressOutput=True, lengthUnitString="mm")
+        with tempfile.TemporaryDirectory() as outputDir:
+            filenames = Core.Helper().SaveFile(os.path.join(outputDir, "bom.csv"), [bomItem, other], prefs)
+            # Databases are never compressed
+            self.assertEqual([os.path.basename(f) for f in filenames],
+                ["bom - SQLite_database_All_properties_indexed.sqlite", "bom - Full_CSV_All_properties.csv.gz"])
+            connection = sqlite3.connect(filenames[0])
+            try:
+                rows = connection.execute("SELECT Name, NormalizedName, Quantity, Width, Length, Height, Thickness, HeightFormatted, Mass "
+                    "FROM Parts WHERE Material = ? AND Thickness = ?", ("Birch", 1.8)).fetchall()
+                indexes = [r[0] for r in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'Parts'")]
+            finally:
+                connection.close()
+        # Raw floats, even with comma decimals
+        self.assertEqual(rows, [("_Birch shelf", "birch shelf", 3, 60.0, 30.0, 1.8, 1.8, "18", 2.0)])
+        self.assertEqual(sorted(indexes), ["PartsMaterialThickness", "PartsNormalizedName", "PartsThickness"])
+
+    def test_materialRollup(self):
+        shelf = Core.BomItem("Shelf", 3, "", Core.PhysicalAttributes(Core.Dimensions(1.8, 60.0, 30.0, "18", "600", "300"), 3240.0, 4000.0, 2.0, 0.0006, "Birch"))
+        side = Core.BomItem("Side", 2, "", Core.PhysicalAttributes(Core.Dimensions(70.0, 1.8, 40.0, "700", "18", "400"), 5040.0, 6000.0, 3.0, 0.0006, "Birch"))
+        back = Core.BomItem("Back", 1, "", Core.PhysicalAttributes(Core.Dimensions(0.6, 70.0, 60.0, "6", "700", "600"), 2520.0, 8500.0, 1.5, 0.0006, "Birch"))
+        for useQuantity in (True, False):
+            prefs = Core.CsvBomPrefs(materialRollup=True, useQuantity=useQuantity, lengthUnitString="mm", useCommaDecimal=True)
+            with tempfile.TemporaryDirectory() as outputDir:
+                # Rows are totalled from the single pass that writes them
+                filenames = Core.Helper().SaveFile(os.path.join(outputDir, "bom.csv"), (i for i in [shelf, side, back]), prefs)
+                self.assertEqual([os.path.basename(f) for f in filenames], ["bom.csv", "bom - Material_rollup.csv"])
+                with open(filenames[1], newline='') as f:
+                    lines = f.read().splitlines()
+            self.assertEqual(lines, [
+                "Material,Thickness mm,Parts,Area cm^2,Volume cm^3,Mass kg",
+                'Birch,18,5,"24000,00","19800,00","12,00000"',
+                'Birch,6,1,"8500,00","2520,00","1,50000"',
+                'Total,,6,"32500,00","22320,00","13,50000"'])
+
+    def test_backgroundExport(self):
+        import threading
+        component = object()
+        item = self.getDefaultBom()
+        item.Component = component
+        completed = []
+        with tempfile.TemporaryDirectory() as outputDir:
+            prefs = Core.CsvBomPrefs(lengthUnitString="mm")
+            export = Core.BackgroundExport(Core.Helper(), os.path.join(outputDir, "bom.csv"), (i for i in [item]), prefs,
+                onComplete=lambda e: completed.append((e.filenames, e.error, threading.current_thread().name)))
+            # The snapshot is detached from the design and from later changes to prefs
+            assert export.bom[0].Component is None and item.Component is component
+            prefs.useQuantity = False
+            export.start().join(10)
+            self.assertEqual(completed, [([os.path.join(outputDir, "bom.csv")], None, "CSV-BOM export")])
+            with open(completed[0][0][0]) as f:
+                assert f.read().splitlines()[1].startswith("My component name,2,")
+
+            # Errors are reported, not raised
+            export = Core.BackgroundExport(Core.Helper(), os.path.join(outputDir, "missing", "bom.csv"), [item], prefs,
+                onComplete=completed.append)
+            export.start().join(10)
+            assert completed[-1].filenames is None and isinstance(completed[-1].error, OSError)
+            assert "FileNotFoundError" in completed[-1].traceback
+
+    def test_skipUnchanged(self):
+        prefs = Core.CsvBomPrefs(skipUnchanged=True, lengthUnitString="mm", outputFormat=[Core.OutputFormats.FullCsv, Core.OutputFormats.GaryDarby])
+        helper = Core.Helper()
+        with tempfile.TemporaryDirectory() as outputDir:
+            filename = os.path.join(outputDir, "bom.csv")
+
+            def export(bom, prefs=prefs):
+                e = Core.BackgroundExport(helper, filename, bom, prefs)
+                e.start().join(10)
+                return e
+
+            first = export([self.getDefaultBom()])
+            assert not first.unchanged and len(first.filenames) == 2
+            assert os.path.exists(helper.HashFilename(filename))
+            # The hash is taken from the rows as they stream by, and matches for the same rows
+            second = export(i for i in [self.getDefaultBom()])
+            assert second.unchanged and second.filenames is None
+            self.assertEqual(second.digest, first.digest)
+
+            changed = self.getDefaultBom()
+            changed.Quantity = 3
+            assert not export([changed]).unchanged
+            # Prefs are part of the hash
+            noQuantity = Core.CsvBomPrefs.from_json(prefs.to_json())
+            noQuantity.useQuantity = False
+            assert not export([changed], noQuantity).unchanged
+            assert export([changed], noQuantity).unchanged
+            # A missing output file is written again
+            os.remove(first.filenames[1])
+            assert not export([changed], noQuantity).unchanged
+            # So is one edited since it was exported
+            edited = export([changed], noQuantity)
+            assert edited.unchanged
+            with open(first.filenames[0], 'a') as f:
+                f.write("Extra,1\n")
+            assert not export([changed], noQuantity).unchanged
+            stamp = os.stat(first.filenames[0])
+            os.utime(first.filenames[0], ns=(stamp.st_atime_ns, stamp.st_mtime_ns + 1000000000))
+            assert not export([changed], noQuantity).unchanged
+
+            # An export with the option off removes the record, so switching back on doesn't skip stale files
+            assert not export([self.getDefaultBom()]).unchanged
+            changed = self.getDefaultBom()
+            changed.Quantity = 5
+            off = Core.CsvBomPrefs.from_json(prefs.to_json())
+            off.skipUnchanged = False
+            assert export([changed], off).filenames and not os.path.exists(helper.HashFilename(filename))
+            assert not export([self.getDefaultBom()]).unchanged
+            assert export([self.getDefaultBom()]).unchanged
+
+    def test_consolidate(self):
+        shelf = self.getBomItem("Shelf (1)", 2, (60.0, 30.0, 1.8), ("600", "300", "18"), material="Birch")
+        side = self.getBomItem("Side", 1, (70.0, 40.0, 1.8), ("700", "400", "18"), material="Birch")
+        helper = Core.Helper()
+        with tempfile.TemporaryDirectory() as outputDir:
+            paths = []
+            # Full CSV, a gzipped full CSV without the quantity field, a delta export, and Maxcut
+            for i, prefs in enumerate([
+                    Core.CsvBomPrefs(lengthUnitString="mm"),
+                    Core.CsvBomPrefs(lengthUnitString="mm", useQuantity=False, compressOutput=True),
+                    Core.CsvBomPrefs(lengthUnitString="mm", deltaExport=True),
+                    Core.CsvBomPrefs(lengthUnitString="mm", outputFormat="Cutlist (Maxcut)")]):
+                bom = [self.getBomItem("shelf v2", 3, (60.0, 30.0, 1.8), ("600", "300", "18"), material="Birch"), side]
+                if prefs.deltaExport:
+                    bom = [Core.BomChange(Core.BomDelta.Added, shelf), Core.BomChange(Core.BomDelta.Removed, side)]
+                paths += helper.SaveFile(os.path.join(outputDir, "design{}.csv".format(i)), bom, prefs)
+
+            def consolidate(maxEntries):
+                output = os.path.join(outputDir, "merged{}.csv".format(maxEntries))
+                helper.ConsolidateFiles(paths, output, maxEntries)
+                with open(output, newline='') as f:
+                    return f.read().splitlines()
+
+            merged = consolidate(100)
+            self.assertEqual(merged, [
+                "Part name,Quantity,Width,Length,Height,Unit,Material",
+                # Maxcut has no thickness or unit, so its parts stay apart
+                "shelf,3,600,300,,,Birch",
+                # 3 + 3 rows without the quantity field + 2 added; the removed side is not counted
+                "shelf,8,600,300,18,mm,Birch",
+                "Side,1,700,400,,,Birch",
+                "Side,2,700,400,18,mm,Birch"])
+            # Spilling sorted runs to disk gives the same result, and cleans up after itself
+            self.assertEqual(consolidate(1), merged)
+            assert not [f for f in os.listdir(outputDir) if f.endswith(".bomrun")]
+
+        with self.assertRaises(ValueError):
+            Core.BomConsolidator().Layout(["Not", "a", "BOM"])
+
+    def test_bomDelta(self):
+        item = self.getBomItem
+        first = Core.BomDelta()
+        written = list(first.record([("a", item("A", 1)), ("b", item("B", 2)), ("c", item("C", 1))]))
+        assert len(written) == 3
+
+        second = Core.BomDelta.from_json(first.to_json())
+        changes = list(second.changes([("a", item("A", 1)), ("b", item("B", 3)), ("d", item("D", 1))]))
+        self.assertEqual([(c.Change, c.Name) for c in changes], [("Changed", "B"), ("Added", "D"), ("Removed", "C")])
+        assert sorted(json.loads(second.to_json()).keys()) == ["a", "b", "d"]
+
+        prefs = Core.CsvBomPrefs(deltaExport=True, lengthUnitString="mm")
+        h = Core.Helper()
+        f = io.StringIO(newline='')
+        h.WriteCsvFromTemplate(f, changes, prefs, h.ParseCsvTemplate(prefs, Core.OutputFormats.MinimalCsvTemplate))
+        self.assertEqual(f.getvalue().splitlines(), [
+            "Change,Part name,Quantity,Width mm,Length mm,Height mm",
+            "Changed,B,3,3,2,1", "Added,D,1,3,2,1", "Removed,C,1,3,2,1"])
+
+        f = io.StringIO(newline='')
+        h.WriteCutlistGaryDarby(f, changes, prefs)
+        assert "C (thickness" not in f.getvalue()
+
+    def test_groupBom(self):
+        item = self.getBomItem
+        bom = [item("Shelf", 2), item("Shelf (1)", 2, (1.001, 2.0, 3.0)), item("shelf v2", 2), item("Shelf", 2, material="MDF"),
+            item("Shelf", 2, (1.5, 2.0, 3.0)), item("Side", 2)]
+        h = Core.Helper()
+        grouped = h.GroupBom(bom, Core.CsvBomPrefs(groupTolerance=0.01))
+        self.assertEqual([(i.Name, i.Quantity) for i in grouped], [("Shelf", 6), ("Shelf", 2), ("Shelf", 2), ("Side", 2)])
+        # The input items are left alone
+        assert bom[0].Quantity == 2
+        self.assertEqual(h.normalizeName("_Shelf  Board v3 (2)"), "shelf board")
+
+    def test_walkerHierarchy(self):
+        snapshot = self.getSnapshot()
+        components = snapshot["components"]
+        # 200 instances of a drawer holding 2 sides; a "_" subassembly is pruned with its children
+        components["root"]["occurrences"] = [{"component": "drawer"}] * 200 + [{"component": "_jig"}]
+        components["drawer"]["occurrences"] = [{"component": "side"}, {"component": "side"}]
+        components["_jig"]["occurrences"] = [{"component": "side"}]
+        design = Headless.StandInDesign(snapshot)
+
+        walker = Walker.BomWalker(design, Core.CsvBomPrefs(), "mm")
+        bom = walker.countComponents(design.rootComponent.occurrences)
+        self.assertEqual([(i.Name, i.Quantity) for i in bom], [("Side (1)", 400)])
+
+        walker = Walker.BomWalker(design, Core.CsvBomPrefs(ignoreUnderscorePrefixedComponents=False, ignoreCompWoBodies=False), "mm")
+        bom = walker.countComponents(design.rootComponent.occurrences)
+        self.assertEqual([(i.Name, i.Quantity) for i in bom], [("Drawer", 200), ("Side (1)", 401), ("_jig", 1)])
+
+        # Overlapping selections: a drawer and a side inside it count once
+        occs = design.rootComponent.allOccurrences
+        selected = walker.topmostOccurrences([occs.item(0), occs.item(1), occs.item(0)])
+        self.assertEqual([o.fullPathName for o in selected], ["Drawer:1"])
+
+    def test_boundingBoxAccuracy(self):
+        snapshot = self.getSnapshot()
+        # A wedge: the API box is 2 x 40 x 5, the body only fills half of it and its mesh is tighter in x
+        snapshot["components"]["side"]["bodies"][0].update(volume=200.0, boundingBox=[0, 0, 0, 2, 40, 5],
+            mesh=[0, 0, 0, 1.8, 40, 5, 0, 40, 0])
+        design = Headless.StandInDesign(snapshot)
+        body = design.rootComponent.occurrences.item(2).component.bRepBodies.item(0)
+
+        def bounds(accuracy):
+            walker = Walker.BomWalker(design, Core.CsvBomPrefs(boundingBoxAccuracy=accuracy), "mm")
+            return walker.calculateBodyBoundingBox(body, body.volume)
+
+        assert bounds(Core.BoundingBoxAccuracy.Fast) == (0, 0, 0, 2, 40, 5)
+        assert bounds(Core.BoundingBoxAccuracy.Auto) == (0, 0, 0, 1.8, 40, 5)
+        assert bounds(Core.BoundingBoxAccuracy.Tight) == (0, 0, 0, 1.8, 40, 5)
+
+        # A plain box never meshes in automatic mode
+        assert Geometry.isFilledBox((0, 0, 0, 2, 40, 5), 400.0, 0.001)
+        assert not Geometry.isFilledBox((0, 0, 0, 2, 40, 5), 200.0, 0.001)
+
+    def test_exportProgress_cancel(self):
+        design = Headless.StandInDesign(self.getSnapshot())
+        reports = []
+        def callback(progress):
+            reports.append(dict(progress.counts))
+            if progress.counts[Core.ExportProgress.Components]:
+                raise Core.ExportCancelledError()
+
+        progress = Core.ExportProgress(callback, chunkSize=1)
+        walker = Walker.BomWalker(design, Core.CsvBomPrefs(), "mm", progress=progress)
+        bom = walker.countComponents(design.rootComponent.occurrences)
+        assert progress.total == 2
+        # Each unique component lists its occurrences once: 4 at the top, 2 in the drawer
+        assert reports[-1][Core.ExportProgress.Occurrences] == 6
+
+        with tempfile.TemporaryDirectory() as outputDir:
+            filename = os.path.join(outputDir, "bom.csv")
+            with self.assertRaises(Core.ExportCancelledError):
+                Core.Helper().SaveFile(filename, walker.generateBomItems(bom), Core.CsvBomPrefs())
+            # No partial file is left behind
+            assert not os.path.exists(filename)
+
+    def test_bodySnapshot(self):
+        class CountingBody:
+            """ Counts every property read on the wrapped body """
+            reads = 0
+            def __init__(self, body):
+                self.__dict__["_body"] = body
+            def __getattr__(self, name):
+                CountingBody.reads += 1
+                return getattr(self._body, name)
+
+        snapshot = self.getSnapshot()
+        snapshot["components"]["side"]["bodies"] += [
+            {"isSolid": False, "volume": 0.0, "material": "Steel", "boundingBox": [0, 0, 0, 100, 100, 100]},
+            {"isSolid": True, "volume": 72.0, "area": 100.0, "mass": 0.1, "density": 0.002, "material": "Walnut",
+             "boundingBox": [0, 0, 5, 1.8, 40, 6]}]
+        design = Headless.StandInDesign(snapshot)
+        side = design.rootComponent.occurrences.item(2).component
+        side.bRepBodies = Headless.StandInCollection(CountingBody(b) for b in side.bRepBodies)
+
+        walker = Walker.BomWalker(design, Core.CsvBomPrefs(), "mm")
+        props = walker.aggregateBodies(walker.snapshotBodies(side.bRepBodies))
+        # Reading each body separately per aggregate took 17 reads for the first solid body and 14 for the next
+        self.assertEqual(CountingBody.reads, 5 + 1 + 5)
+        self.assertEqual((props["x"], props["y"], props["z"]), (1.8, 40, 6))
+        self.assertEqual((props["volume"], props["area"], props["mass"], props["density"]), (432.0, 1100.0, 0.35, 0.0007))
+        self.assertEqual(props["material"], "Oak, Walnut")
+
+    def test_profiler(self):
+        design = Headless.StandInDesign(self.getSnapshot())
+        profiler = Core.Profiler()
+        walker = Walker.BomWalker(design, Core.CsvBomPrefs(boundingBoxAccuracy=Core.BoundingBoxAccuracy.Tight), "mm", profiler=profiler)
+        bom = walker.countComponents(design.rootComponent.occurrences)
+        helper = Core.Helper(profiler)
+        with tempfile.TemporaryDirectory() as outputDir:
+            filename = os.path.join(outputDir, "bom.csv")
+            helper.SaveFile(filename, walker.generateBomItems(bom), Core.CsvBomPrefs())
+            sidecar = json.loads(open(profiler.WriteSidecar(filename)).read())
+
+        for phase in [Walker.BomWalker.WalkPhase, Walker.BomWalker.SnapshotPhase, Walker.BomWalker.PhysicalPhase,
+                Walker.BomWalker.FormatPhase, Core.Helper.ParsePhase, Core.Helper.WritePhase]:
+            assert phase in sidecar, phase
+        assert sidecar[Walker.BomWalker.SnapshotPhase]["calls"] == 2
+        assert sidecar[Walker.BomWalker.FormatPhase]["apiCalls"] == 6
+        assert sidecar[Walker.BomWalker.WalkPhase]["apiCalls"] > 0
+
+        # Disabled profilers record nothing
+        disabled = Core.Profiler(enabled=False)
+        with disabled.phase("x"):
+            disabled.count()
+        assert not disabled.phases
+
+    def test_saveFile_atomicAndCompressed(self):
+        bomItem = self.getDefaultBom()
+        h = Core.Helper()
+        with tempfile.TemporaryDirectory() as outputDir:
+            filename = os.path.join(outputDir, "bom.csv")
+            with open(filename, 'w') as f:
+                f.write("previous export")
+
+            def failing():
+                yield bomItem
+                raise RuntimeError("walk failed")
+            with self.assertRaises(RuntimeError):
+                h.SaveFile(filename, failing(), Core.CsvBomPrefs())
+            # The previous file is untouched and no temporary file is left over
+            with open(filename) as f:
+                assert f.read() == "previous export"
+            assert os.listdir(outputDir) == ["bom.csv"]
+
+            # Nor when flushing the last buffer fails as the file is closed
+            output = Core.AtomicOutput(filename)
+            with self.assertRaises(OSError):
+                with output as stream:
+                    stream.write("partial")
+                    class FullDisk:
+                        def close(self):
+                            stream.close()
+                            raise OSError("No space left on device")
+                    output.stream = FullDisk()
+            with open(filename) as f:
+                assert f.read() == "previous export"
+            assert os.listdir(outputDir) == ["bom.csv"]
+            # A file that can't be replaced leaves no temporary file behind
+            locked = os.path.join(outputDir, "locked")
+            os.mkdir(locked)
+            with self.assertRaises(OSError):
+                with Core.AtomicOutput(locked) as stream:
+                    stream.write("new export")
+            self.assertEqual(sorted(os.listdir(outputDir)), ["bom.csv", "locked"])
+            os.rmdir(locked)
+
+            prefs = Core.CsvBomPrefs(useQuantity=False, compressOutput=True)
+            filenames = h.SaveFile(filename, [bomItem], prefs)
+            assert filenames == [filename + ".gz"]
+            expected = io.StringIO(newline='')
+            h.WriteCsvFromTemplate(expected, [bomItem], prefs, h.ParseCsvTemplate(prefs, Core.OutputFormats.FullCsvTemplate))
+            with gzip.open(filenames[0], 'rt', newline='') as f:
+                self.assertEqual(f.read(), expected.getvalue())
+
     def test_prefs(self):
         start = Core.CsvBomPrefs()
         # Override two defaults
@@ -95,6 +750,24 @@ My component name,60,5 0/0,4 0/0,3 0/0,20.00,60.00000,1.00000,Water,This is my m
         #self.assertMultiLineEqual(val == expected) #Fails due to \r\n and \n inconsistencies 
         self.assertEqual(val.splitlines(), expected.splitlines()) #Works as it compares contents of the array, each line of the string
 
+    def test_CsvWrite_commaDecimal(self):
+        bomItem = self.getDefaultBom()
+        bomItem.PhysicalAttributes.Volume = 60.5
+
+        prefs = Core.CsvBomPrefs(useCommaDecimal=True, sortDimensions=False, lengthUnitString="mm")
+        h = Core.Helper()
+        f = io.StringIO(newline='')
+        template = h.ParseCsvTemplate(prefs, Core.OutputFormats.MinimalCsvTemplate)
+        h.WriteCsvFromTemplate(f, [bomItem], prefs, template)
+        h.WriteCsvFromTemplate(f, [bomItem], prefs, h.ParseCsvTemplate(prefs, Core.OutputFormats.FullCsvTemplate))
+
+        expected = """Part name,Quantity,Width mm,Length mm,Height mm
+My component name,2,3 0/0,4 0/0,5 0/0
+Part name,Quantity,Volume cm^3,Width mm,Length mm,Height mm,Area cm^2,Mass kg,Density kg/cm^2,Material,Description
+My component name,2,"60,5",3 0/0,4 0/0,5 0/0,"20,00","60,00000","1,00000",Water,This is my mocked component
+"""
+        self.assertEqual(f.getvalue().splitlines(), expected.splitlines())
+
     
     def test_cutlistGaryDarby(self):
         bomItem = self.getDefaultBom()
@@ -119,8 +792,30 @@ Available
         self.assertEqual(val.splitlines(), expected.splitlines())
 
 
+    def test_cutlistGaryDarby_emptyName(self):
+        # A component named only "(1)" filters to an empty name
+        item = self.getDefaultBom()
+        item.Name = "(1)"
+        prefs = Core.CsvBomPrefs(ignoreUnderscorePrefixedComponents=False, stripUnderscorePrefix=True)
+        stream = io.StringIO()
+        Core.Helper().WriteCutlistGaryDarby(stream, [item], prefs)
+        assert " 5 0/0\t4 0/0\t (thickness: 3 0/0)\n" in stream.getvalue()
 
+    def test_cutlistGaryDarby_streamed(self):
+        integers = Core.BomItem("Integers", 1, "", Core.PhysicalAttributes(Core.Dimensions(3, 4, 5, "3", "4", "5"), 0, 0, 0, 0, ""))
+        fraction = Core.BomItem("Fraction", 1, "", Core.PhysicalAttributes(Core.Dimensions(3, 4, 5, "3 1/2", "4", "5"), 0, 0, 0, 0, ""))
+        prefs = Core.CsvBomPrefs(sortDimensions=False)
 
+        h = Core.Helper()
+        f = io.StringIO(newline='')
+        # A generator is consumed once; the inconclusive first item is held until the fraction is seen
+        h.WriteCutlistGaryDarby(f, (i for i in [integers, fraction]), prefs)
+        lines = f.getvalue().splitlines()
+        self.assertEqual(lines[4:6], [" 3 0/0\t4 0/0\tIntegers (thickness: 5 0/0)", " 3 1/2\t4 0/0\tFraction (thickness: 5 0/0)"])
+
+        f = io.StringIO(newline='')
+        h.WriteCutlistGaryDarby(f, iter([integers]), prefs, useFractions=True)
+        self.assertEqual(f.getvalue().splitlines()[4], " 3 0/0\t4 0/0\tIntegers (thickness: 5 0/0)")
 
     def test_parseCsvTemplate(self):
         h = Core.Helper()
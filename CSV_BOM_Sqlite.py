@@ -0,0 +1,101 @@
+# Writes the BOM into an indexed SQLite database for querying by other tools, e.g.
+#  SELECT Material, SUM(Mass * Quantity) FROM Parts GROUP BY Material
+# Registered in CSV_BOM_Core.OutputFormats as a file writer, so sqlite3 is only imported when the format is exported.
+# Numbers are stored as raw floats in Fusion's internal units (cm, cm^2, cm^3, kg), next to the formatted dimensions.
+
+import itertools
+import sqlite3
+
+
+SchemaVersion = 1
+BatchSize = 10000
+
+Schema = """
+CREATE TABLE Export (Key TEXT PRIMARY KEY, Value TEXT);
+CREATE TABLE Parts (
+    Id INTEGER PRIMARY KEY,
+    Name TEXT,
+    NormalizedName TEXT,
+    Quantity INTEGER,
+    Width REAL,
+    Length REAL,
+    Height REAL,
+    Thickness REAL,
+    WidthFormatted TEXT,
+    LengthFormatted TEXT,
+    HeightFormatted TEXT,
+    Volume REAL,
+    Area REAL,
+    Mass REAL,
+    Density REAL,
+    Material TEXT,
+    Description TEXT,
+    Change TEXT
+);
+"""
+
+# Created after the rows are inserted, which is much faster than maintaining them row by row
+Indexes = """
+CREATE INDEX PartsMaterialThickness ON Parts (Material, Thickness);
+CREATE INDEX PartsThickness ON Parts (Thickness);
+CREATE INDEX PartsNormalizedName ON Parts (NormalizedName);
+"""
+
+InsertParts = "INSERT INTO Parts (Name, NormalizedName, Quantity, Width, Length, Height, Thickness, " \
+    "WidthFormatted, LengthFormatted, HeightFormatted, Volume, Area, Mass, Density, Material, Description, Change) " \
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+
+def partRows(helper, bom, prefs):
+    """ One tuple per BomItem, named and ordered like the CSV exports """
+    stripUnderscore = prefs.ignoreUnderscorePrefixedComponents is False and prefs.stripUnderscorePrefix is True
+    for item in bom:
+        name = helper.filterFusionCompNameInserts(item.Name)
+        if stripUnderscore and name.startswith('_'):
+            name = name[1:]
+        physical = item.PhysicalAttributes
+        dims = physical.Dimensions
+        # Sorted largest first, so thickness is the last sorted dimension
+        x, y, z = dims.GetSortedTuples()
+        thickness = z[0]
+        if not prefs.sortDimensions:
+            x, y, z = dims.GetArray()
+        yield (name, helper.normalizeName(item.Name), item.Quantity,
+            x[0], y[0], z[0], thickness,
+            x[1], y[1], z[1],
+            physical.Volume, physical.Area, physical.Mass, physical.Density, physical.Material, item.Description,
+            getattr(item, "Change", None))
+
+
+def executeStatements(connection, script):
+    """ Run each statement of script inside the open transaction (executescript would commit it) """
+    for statement in script.split(';'):
+        if statement.strip():
+            connection.execute(statement)
+
+
+def WriteSqlite(helper, filename, bom, prefs, useFractions=None):
+    connection = sqlite3.connect(filename, isolation_level=None)
+    try:
+        # The file is a fresh temporary file that only replaces the export once complete, so skip the journal
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute("PRAGMA locking_mode = EXCLUSIVE")
+        # Room to sort the index keys in memory
+        connection.execute("PRAGMA cache_size = -65536")
+        connection.execute("BEGIN")
+        executeStatements(connection, Schema)
+        connection.executemany("INSERT INTO Export (Key, Value) VALUES (?, ?)", [
+            ("schemaVersion", str(SchemaVersion)),
+            ("lengthUnit", prefs.lengthUnitString),
+            ("prefs", prefs.to_json())])
+        rows = partRows(helper, bom, prefs)
+        while True:
+            batch = list(itertools.islice(rows, BatchSize))
+            if not batch:
+                break
+            connection.executemany(InsertParts, batch)
+        executeStatements(connection, Indexes)
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
@@ -0,0 +1,291 @@
+# Walks the Fusion 360 component tree and gathers the BomItems for CSV_BOM_Core.
+# This file only touches the objects it is handed (design, occurrences, components, bodies) and never imports adsk,
+#  so it runs unchanged against the local stand-in objects in CSV_BOM_Headless.
+
+try:
+    from . import CSV_BOM_Core as Core
+    from . import CSV_BOM_Geometry as Geometry
+except ImportError:
+    import CSV_BOM_Core as Core
+    import CSV_BOM_Geometry as Geometry
+
+
+class ModulesNotLoadedError(Exception):
+    """ Raised while walking the design when a body has no display mesh yet """
+    pass
+
+
+class BodySnapshot:
+    """ What the BOM needs from one body, read from the API once """
+    __slots__ = ("isSolid", "volume", "area", "mass", "density", "material", "bounds")
+
+    def __init__(self, isSolid, volume=0, material="", bounds=None):
+        self.isSolid = isSolid
+        self.volume = volume
+        self.area = 0
+        self.mass = 0
+        self.density = 0
+        self.material = material
+        # (minX, minY, minZ, maxX, maxY, maxZ), or None if the body could not be measured
+        self.bounds = bounds
+
+
+class BomWalker:
+    # Phase names recorded in the profiler
+    WalkPhase = "occurrence walk"
+    SnapshotPhase = "body snapshots"
+    PhysicalPhase = "physical properties"
+    FormatPhase = "unit formatting"
+
+    # Components whose formatted dimensions are compared against the API before trusting Core.LengthFormatter
+    FormatterCheckSamples = 3
+
+    def __init__(self, design, prefs: Core.CsvBomPrefs, preferredUnits, cache: Core.ComponentCache=None, progress: Core.ExportProgress=None,
+                 profiler: Core.Profiler=None):
+        self.design = design
+        self.prefs = prefs
+        self.preferredUnits = preferredUnits
+        self.cache = cache if cache is not None else Core.ComponentCache()
+        self.progress = progress if progress is not None else Core.ExportProgress()
+        self.profiler = profiler if profiler is not None else Core.Profiler(enabled=False)
+        self._excluded = {}
+        self.formatter = None
+
+    # Calculates a tight bounding box around the input body.  An optional
+    # tolerance argument is available.  This specificies the tolerance in
+    # centimeters.  If not provided the best existing display mesh is used.
+    # Returns a (minX, minY, minZ, maxX, maxY, maxZ) tuple.
+    def calculateTightBoundingBox(self, body, tolerance=0):
+        try:
+            # If the tolerance is zero, use the best display mesh available.
+            if tolerance <= 0:
+                # Get the best display mesh available.
+                triMesh = body.meshManager.displayMeshes.bestMesh
+                self.profiler.count(3)
+            else:
+                # Calculate a new mesh based on the input tolerance.
+                meshMgr = body.meshManager
+                meshCalc = meshMgr.createMeshCalculator()
+                meshCalc.surfaceTolerance = tolerance
+                triMesh = meshCalc.calculate()
+                self.profiler.count(4)
+
+            # Calculate the range of the mesh from the flat coordinate array in a single pass.
+            self.profiler.count()
+            return Geometry.boundsFromCoordinates(triMesh.nodeCoordinatesAsDouble)
+        except:
+            # An error occurred so return None.
+            return None
+
+    def calculateBodyBoundingBox(self, body, volume):
+        """ Bounds of one body at the accuracy chosen in prefs. Automatic uses the cheap API box and only meshes
+        the body when it does not fill that box (i.e. it is not a plain axis-aligned prism). """
+        accuracy = self.prefs.boundingBoxAccuracy
+        if accuracy in (Core.BoundingBoxAccuracy.Auto, Core.BoundingBoxAccuracy.Fast):
+            box = body.boundingBox
+            self.profiler.count(8)
+            bounds = (box.minPoint.x, box.minPoint.y, box.minPoint.z, box.maxPoint.x, box.maxPoint.y, box.maxPoint.z)
+            if accuracy == Core.BoundingBoxAccuracy.Fast \
+                    or Geometry.isFilledBox(bounds, volume, Core.BoundingBoxAccuracy.fillThreshold):
+                return bounds
+        if accuracy == Core.BoundingBoxAccuracy.Tolerance:
+            return self.calculateTightBoundingBox(body, self.prefs.meshTolerance)
+        return self.calculateTightBoundingBox(body, 0)
+
+    def snapshotBody(self, body) -> BodySnapshot:
+        """ Read everything the BOM needs from a body, touching each API property once """
+        self.profiler.count()
+        if not body.isSolid:
+            return BodySnapshot(False)
+        self.profiler.count(4)
+        volume = body.volume
+        physical = body.physicalProperties
+        material = body.material
+        snapshot = BodySnapshot(True, volume, material.name if material else "", self.calculateBodyBoundingBox(body, volume))
+        if physical:
+            self.profiler.count(3)
+            snapshot.area = physical.area
+            snapshot.mass = physical.mass
+            snapshot.density = physical.density
+        return snapshot
+
+    def snapshotBodies(self, bodies) -> list:
+        self.profiler.count()
+        return [self.snapshotBody(body) for body in bodies]
+
+    def aggregateBodies(self, snapshots) -> dict:
+        """ Totals for a component from its body snapshots in one pass, or None if a body has no bounds yet.
+        Density is that of the first body (0 without bodies); materials are listed once each in body order. """
+        volume = area = mass = 0
+        density = snapshots[0].density if snapshots else 0
+        materials = []
+        boxes = []
+        for body in snapshots:
+            if not body.isSolid:
+                continue
+            if not body.bounds:
+                return None
+            boxes.append(body.bounds)
+            volume += body.volume
+            area += body.area
+            mass += body.mass
+            if body.material and body.material not in materials:
+                materials.append(body.material)
+        size = Geometry.boundsSize(Geometry.unionBounds(boxes))
+        if not size:
+            return None
+        return {
+            "x": size['x'],
+            "y": size['y'],
+            "z": size['z'],
+            "volume": volume,
+            "area": area,
+            "mass": mass,
+            "density": density,
+            "material": ', '.join(materials)
+        }
+
+    def getComponentFingerprint(self, comp):
+        """ Changes whenever the component is modified (or measured differently), invalidating its cached geometry """
+        return "{}:{}:{}:{}".format(comp.revisionId, comp.bRepBodies.count, self.prefs.boundingBoxAccuracy, self.prefs.meshTolerance)
+
+    def isExcludedComponent(self, comp):
+        """ Excluded components are pruned together with everything below them """
+        token = comp.entityToken
+        excluded = self._excluded.get(token)
+        if excluded is None:
+            prefs = self.prefs
+            self.profiler.count(3)
+            excluded = (comp.name.startswith('_') and prefs.ignoreUnderscorePrefixedComponents) \
+                or (prefs.ignoreLinkedComponents and self.design != comp.parentDesign)
+            self._excluded[token] = excluded
+        return excluded
+
+    def isPrunedOccurrence(self, occ):
+        # occ is a native occurrence of its parent component, so visibility overrides on a single instance of the parent
+        #  (set through an assembly context) are not seen; see "Ignore visible state" in the README
+        if not occ.isVisible and self.prefs.ignoreVisibleState is False:
+            return True
+        return self.isExcludedComponent(occ.component)
+
+    def topmostOccurrences(self, occs):
+        """ Deduplicate selected occurrences, dropping any that lie inside another selected occurrence """
+        byPath = {}
+        for occ in occs:
+            byPath.setdefault(occ.fullPathName, occ)
+        result = []
+        kept = set()
+        for path in sorted(byPath):
+            # Paths look like "Cabinet:1+Drawer:2"; sorted order puts a parent before its children
+            parts = path.split('+')
+            if any('+'.join(parts[:i]) in kept for i in range(1, len(parts))):
+                continue
+            kept.add(path)
+            result.append(byPath[path])
+        return result
+
+    def countComponents(self, topOccurrences) -> Core.BomAccumulator:
+        """ Count the instances of each unique component below topOccurrences (e.g. root.occurrences), keyed on the
+        component's entity token. Each unique component is visited once and its instance count is the sum of its parents'
+        counts, so a subassembly instanced 200 times is not walked 200 times. Rows are in first-seen depth-first order
+        and carry no PhysicalAttributes; see generateBomItems. """
+        with self.profiler.phase(BomWalker.WalkPhase):
+            return self._countComponents(topOccurrences)
+
+    def _countComponents(self, topOccurrences) -> Core.BomAccumulator:
+        self._excluded = {}
+        components = {}
+        children = {}
+        preorder = []
+        postorder = []
+
+        def visit(comp):
+            token = comp.entityToken
+            components[token] = comp
+            preorder.append(token)
+            occurrences = comp.occurrences
+            included = [occ.component for occ in occurrences if not self.isPrunedOccurrence(occ)]
+            children[token] = included
+            self.progress.step(Core.ExportProgress.Occurrences, len(occurrences))
+            # The occurrence list, then isVisible and component per occurrence
+            self.profiler.count(1 + 2 * len(occurrences))
+            for child in included:
+                if child.entityToken not in components:
+                    visit(child)
+            postorder.append(token)
+
+        top = [occ.component for occ in topOccurrences if not self.isPrunedOccurrence(occ)]
+        self.progress.step(Core.ExportProgress.Occurrences, len(topOccurrences))
+        for comp in top:
+            if comp.entityToken not in components:
+                visit(comp)
+
+        # Reverse postorder visits every parent before its children, so counts are final when propagated
+        counts = dict.fromkeys(components, 0)
+        for comp in top:
+            counts[comp.entityToken] += 1
+        for token in reversed(postorder):
+            count = counts[token]
+            for child in children[token]:
+                counts[child.entityToken] += count
+
+        bom = Core.BomAccumulator()
+        for token in preorder:
+            comp = components[token]
+            if not comp.bRepBodies.count and self.prefs.ignoreCompWoBodies:
+                continue
+            bom.add(token, Core.BomItem(comp.name, counts[token], comp.description, None, comp))
+        self.progress.total = len(bom)
+        self.progress.report()
+        return bom
+
+    def getLengthFormatter(self):
+        """ A Core.LengthFormatter matching the design's display settings, or None to format through the API """
+        if self.formatter is None:
+            self.profiler.count()
+            self.formatter = Core.LengthFormatter.FromUnitsManager(self.design.fusionUnitsManager, self.preferredUnits)
+        return self.formatter
+
+    def generateBomItems(self, bom: Core.BomAccumulator, table: Core.BomTable=None):
+        """ Append each counted component to table (a new Core.BomTable by default) with its geometry and physical
+        properties, reusing cached geometry if the component is unchanged, and yield the BomTableRow for it """
+        unitsManager = self.design.fusionUnitsManager
+        preferredUnits = self.preferredUnits
+        cache = self.cache
+        cache.reserve(len(bom))
+        formatter = self.getLengthFormatter()
+        checksLeft = self.FormatterCheckSamples
+        if table is None:
+            table = Core.BomTable()
+        for item in bom:
+            self.progress.step(Core.ExportProgress.Components)
+            comp = item.Component
+            fingerprint = self.getComponentFingerprint(comp)
+            props = cache.get(comp.entityToken, fingerprint)
+            if props is None:
+                with self.profiler.phase(BomWalker.SnapshotPhase):
+                    snapshots = self.snapshotBodies(comp.bRepBodies)
+                with self.profiler.phase(BomWalker.PhysicalPhase):
+                    props = self.aggregateBodies(snapshots)
+                if not props:
+                    raise ModulesNotLoadedError()
+                cache.put(comp.entityToken, fingerprint, props)
+
+            with self.profiler.phase(BomWalker.FormatPhase):
+                if formatter is not None:
+                    formatted = [formatter.Format(props[axis]) for axis in ('x', 'y', 'z')]
+                    if checksLeft:
+                        checksLeft -= 1
+                        self.profiler.count(3)
+                        if formatter.Check(unitsManager, [props[axis] for axis in ('x', 'y', 'z')]):
+                            # Fusion formats differently than expected; use the API for the rest of the export
+                            formatter = None
+                if formatter is None:
+                    self.profiler.count(3)
+                    # http://help.autodesk.com/view/fusion360/ENU/?guid=GUID-40dda15b-8dec-4122-b0fa-cbd604cd35b
+                    formatted = [unitsManager.formatInternalValue(props[axis], preferredUnits, False) for axis in ('x', 'y', 'z')]
+            # Dimensions are x,y,z numeric internal units (cm) and string-formatted per the model & user preferences
+            table.appendValues(item.Name, item.Quantity, item.Description,
+                props['x'], props['y'], props['z'], formatted[0], formatted[1], formatted[2],
+                props['volume'], props['area'], props['mass'], props['density'], props['material'], comp)
+            yield table[len(table) - 1]